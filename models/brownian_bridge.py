@@ -1,7 +1,11 @@
+from collections import deque
+
 import numpy as np
 
 from scipy.special import ndtri
 
+from models import instrumentation
+
 
 class BrownianBridge:
     def __init__(self, times):
@@ -9,91 +13,95 @@ class BrownianBridge:
         n_times = len(times)
         self.n_times = n_times
 
-        step_map = np.zeros((n_times,), int)
         self.left_index = np.zeros((n_times,), int)
         self.bridge_index = np.zeros((n_times,), int)
         self.right_index = np.zeros((n_times,), int)
 
-        self.left_weight = np.zeros((n_times,), float)
-        self.right_weight = np.zeros((n_times,), float)
-        self.stddev = np.zeros((n_times,), float)
-
-        step_map[n_times - 1] = 1
         self.bridge_index[0] = n_times - 1
-        self.stddev[0] = np.sqrt(times[n_times - 1])
-        self.left_weight[0] = 0.0
-        self.right_weight[0] = 0.0
 
-        j = 0
-        k = 0
-        l = 0
-
-        def index_where(pred, l, i_start):
-            for i, v in enumerate(l[i_start:]):
-                if pred(v):
-                    return i + i_start
-            return -1
-
-        def is_zero(n):
-            return n == 0
-
-        def is_non_zero(n):
-            return n != 0
-
-        for i in range(1, n_times):
-            j = index_where(is_zero, step_map, j)
-            k = j
-            k = index_where(is_non_zero, step_map, k)
+        # Bisect the unfilled gaps breadth first, left to right. Each entry is a gap
+        # of unfilled indices [j, k - 1] whose right end point k is already known.
+        gaps = deque([(0, n_times - 1)])
+        i = 1
+        while gaps:
+            j, k = gaps.popleft()
+            if j >= k:
+                continue
             l = j + ((k - 1 - j) >> 1)
 
-            step_map[l] = i
             self.bridge_index[i] = l
             self.left_index[i] = j
             self.right_index[i] = k
+            i += 1
 
-            if j > 0:
+            gaps.append((j, l))
+            gaps.append((l + 1, k))
 
-                if times[k] == times[j - 1]:
-                    self.left_weight[i] = 1.0
-                else:
-                    self.left_weight[i] = (times[k] - times[l]) / (times[k] - times[j - 1])
-                self.stddev[i] = np.sqrt((times[l] - times[j - 1]) * self.left_weight[i])
-            else:
-                if times[k] == 0.0:
-                    self.left_weight[i] = 1.0
-                else:
-                    self.left_weight[i] = (times[k] - times[l]) / times[k]
-                self.stddev[i] = np.sqrt(times[l] * self.left_weight[i])
+        times = np.asarray(times, float)
+        j = self.left_index[1:]
+        k = self.right_index[1:]
+        l = self.bridge_index[1:]
+        t_left = np.where(j > 0, times[j - 1], 0.0)
+        t_right = times[k]
+        t_bridge = times[l]
 
-            self.right_weight[i] = 1.0 - self.left_weight[i]
+        self.left_weight = np.zeros((n_times,), float)
+        self.right_weight = np.zeros((n_times,), float)
+        self.stddev = np.zeros((n_times,), float)
 
-            j = k + 1
-            if j >= n_times:
-                j = 0
+        self.stddev[0] = np.sqrt(times[n_times - 1])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.left_weight[1:] = np.where(
+                t_right == t_left, 1.0, (t_right - t_bridge) / (t_right - t_left)
+            )
+        self.stddev[1:] = np.sqrt((t_bridge - t_left) * self.left_weight[1:])
+        self.right_weight[1:] = 1.0 - self.left_weight[1:]
 
     def generate(self, uniform_sample):
 
         if len(uniform_sample) != len(self.times):
             raise (Exception(f"uniform sample has invalid length"))
 
-        normal_sample = ndtri(uniform_sample)
-        path = np.zeros((self.n_times,), float)
-        path[self.n_times - 1] = self.stddev[0] * normal_sample[0]
+        return self.generate_batch(np.reshape(uniform_sample, (self.n_times, 1)))[:, 0]
+
+    def generate_batch(self, uniforms, out=None):
+
+        if len(uniforms) != len(self.times):
+            raise (Exception(f"uniform sample has invalid length"))
+
+        with instrumentation.timer("bridge.generate"):
+            out = self._generate_batch(uniforms, out)
+        instrumentation.count("bridge.paths", uniforms.shape[1])
+        return out
+
+    def _generate_batch(self, uniforms, out):
+
+        n_paths = uniforms.shape[1]
+        if out is None:
+            out = np.zeros((self.n_times, n_paths), float)
+        elif out.shape != (self.n_times, n_paths):
+            raise Exception(f"Output has shape {out.shape}, expected {(self.n_times, n_paths)}")
 
-        i_time = 1
+        left_term = np.zeros((n_paths,), out.dtype)
+        right_term = np.zeros((n_paths,), out.dtype)
 
-        while i_time < self.n_times:
+        # Rows are filled in bridge order, so the neighbours of each new point are already final
+        ndtri(uniforms[0], out=out[self.n_times - 1])
+        out[self.n_times - 1] *= self.stddev[0]
+
+        for i_time in range(1, self.n_times):
             j = self.left_index[i_time]
             k = self.right_index[i_time]
             l = self.bridge_index[i_time]
 
-            if j > 0:
-                path[l] = self.left_weight[i_time] * path[j - 1] + \
-                          self.right_weight[i_time] * path[k] + \
-                          self.stddev[i_time] * normal_sample[i_time]
-            else:
-                path[l] = self.right_weight[i_time] * path[k] + self.stddev[i_time] * normal_sample[i_time]
+            path = out[l]
+            ndtri(uniforms[i_time], out=path)
+            path *= self.stddev[i_time]
 
-            i_time += 1
+            np.multiply(out[k], self.right_weight[i_time], out=right_term)
+            if j > 0:
+                np.multiply(out[j - 1], self.left_weight[i_time], out=left_term)
+                right_term += left_term
+            path += right_term
 
-        return path
+        return out
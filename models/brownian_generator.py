@@ -1,28 +1,179 @@
+from concurrent.futures import ProcessPoolExecutor
+from enum import Enum
+
 import numpy as np
 
+from models import instrumentation
 from models.brownian_bridge import BrownianBridge
-from models.sobol_generator import SobolGenerator
+from models.sobol_generator import SobolGenerator, sobol_shards
+
+
+class BrownianLayout(Enum):
+    PATH_MAJOR = 1  # (n_paths, n_variables, n_times)
+    TIME_MAJOR = 2  # (n_times, n_variables, n_paths)
+
+
+class Factorization(Enum):
+    CHOLESKY = 1
+    PCA = 2
+
+
+class DimensionOrdering(Enum):
+    INTERLEAVED = 1  # bridge step by bridge step, all variables at each step
+    FACTOR_MAJOR = 2  # all bridge steps of one variable before the next
+    IMPORTANCE = 3  # by factor variance times bridge step variance, largest first
+
+
+def factor_loadings(correlation, factorization: Factorization = Factorization.CHOLESKY):
+    correlation = np.asarray(correlation, float)
+    if factorization is Factorization.CHOLESKY:
+        return np.linalg.cholesky(correlation)
+    if factorization is Factorization.PCA:
+        eigenvalues, eigenvectors = np.linalg.eigh(correlation)
+        order = np.argsort(eigenvalues)[::-1]
+        return eigenvectors[:, order] * np.sqrt(np.maximum(eigenvalues[order], 0.0))
+    raise Exception(f"Unexpected factorization {factorization}")
+
 
+def sobol_dimensions(factor_variances, step_variances, ordering: DimensionOrdering):
+    # Sobol dimension used for each (variable, bridge step)
+    n_variables = len(factor_variances)
+    n_times = len(step_variances)
+    if ordering is DimensionOrdering.INTERLEAVED:
+        return np.arange(n_variables * n_times).reshape(n_times, n_variables).T
+    if ordering is DimensionOrdering.FACTOR_MAJOR:
+        return np.arange(n_variables * n_times).reshape(n_variables, n_times)
+    if ordering is DimensionOrdering.IMPORTANCE:
+        importance = np.outer(step_variances, factor_variances).ravel()
+        dimensions = np.zeros((n_variables * n_times,), int)
+        dimensions[np.argsort(-importance, kind="stable")] = np.arange(n_variables * n_times)
+        return dimensions.reshape(n_times, n_variables).T
+    raise Exception(f"Unexpected ordering {ordering}")
 
-def brownians_from_uniforms(uniforms, n_variables, times):
+
+def brownians_shape(n_paths: int, n_variables: int, n_times: int, layout: BrownianLayout):
+    if layout is BrownianLayout.PATH_MAJOR:
+        return n_paths, n_variables, n_times
+    if layout is BrownianLayout.TIME_MAJOR:
+        return n_times, n_variables, n_paths
+    raise Exception(f"Unexpected layout {layout}")
+
+
+def brownians_at(brownians, i_time, layout: BrownianLayout = BrownianLayout.PATH_MAJOR):
+    # All variables at one time, as an (n_variables, n_paths) view
+    if layout is BrownianLayout.PATH_MAJOR:
+        return np.transpose(brownians[:, :, i_time])
+    if layout is BrownianLayout.TIME_MAJOR:
+        return brownians[i_time]
+    raise Exception(f"Unexpected layout {layout}")
+
+
+def brownians_from_uniforms(
+        uniforms,
+        n_variables,
+        times,
+        layout: BrownianLayout = BrownianLayout.PATH_MAJOR,
+        dtype=float,
+        out=None,
+        loadings=None,
+        ordering: DimensionOrdering = DimensionOrdering.INTERLEAVED):
     n_paths = len(uniforms[0])
     n_times = len(times)
 
     if uniforms.shape != (n_variables * n_times, n_paths):
         raise Exception("Shape for brownians doesn't match")
 
-    brownians = np.zeros((n_paths, n_variables, n_times))
+    shape = brownians_shape(n_paths, n_variables, n_times, layout)
+    if out is None:
+        out = np.zeros(shape, dtype)
+    elif out.shape != shape:
+        raise Exception(f"Output has shape {out.shape}, expected {shape}")
+
     bridge = BrownianBridge(times)
+    factor_variances = np.ones((n_variables,)) if loadings is None else np.sum(np.square(loadings), axis=0)
+    dimensions = sobol_dimensions(factor_variances, np.square(bridge.stddev), ordering)
+
+    for i_var in range(n_variables):
+        if layout is BrownianLayout.PATH_MAJOR:
+            paths = np.transpose(out[:, i_var, :])
+        else:
+            paths = out[:, i_var, :]
+        if ordering is DimensionOrdering.INTERLEAVED:
+            var_uniforms = uniforms[i_var::n_variables]
+        else:
+            var_uniforms = uniforms[dimensions[i_var]]
+        bridge.generate_batch(var_uniforms, out=paths)
+
+    # Both layouts keep variables on axis 1, so one broadcast matmul mixes every slice
+    if loadings is not None:
+        np.matmul(loadings, out, out=out)
 
-    var_range = range(n_variables)
-    for i_path in range(n_paths):
-        for i_var in var_range:
-            brownians[i_path, i_var, :] = bridge.generate(uniforms[i_var::n_variables, i_path])
+    return out
 
-    return brownians
 
+def generate_brownians(
+        n_paths: int,
+        n_variables: int,
+        times,
+        start: int = 0,
+        n_processes: int = 1,
+        seed=None,
+        layout: BrownianLayout = BrownianLayout.PATH_MAJOR,
+        dtype=float,
+        out=None,
+        correlation=None,
+        factorization: Factorization = Factorization.CHOLESKY,
+        ordering: DimensionOrdering = DimensionOrdering.INTERLEAVED):
+    if n_processes > 1:
+        shards = sobol_shards(n_paths, n_processes, start)
+        with ProcessPoolExecutor(max_workers=len(shards)) as executor:
+            blocks = list(executor.map(
+                generate_brownians,
+                [n for _, n in shards],
+                [n_variables] * len(shards),
+                [times] * len(shards),
+                [s for s, _ in shards],
+                [1] * len(shards),
+                [seed] * len(shards),
+                [layout] * len(shards),
+                [dtype] * len(shards),
+                [None] * len(shards),
+                [correlation] * len(shards),
+                [factorization] * len(shards),
+                [ordering] * len(shards)
+            ))
+        path_axis = 0 if layout is BrownianLayout.PATH_MAJOR else 2
+        if out is None:
+            return np.concatenate(blocks, axis=path_axis)
+        return np.concatenate(blocks, axis=path_axis, out=out)
 
-def generate_brownians(n_paths: int, n_variables: int, times):
     n_times = len(times)
-    uniforms = SobolGenerator(n_variables * n_times).generate(n_paths)
-    return brownians_from_uniforms(uniforms, n_variables, times)
+    with instrumentation.timer("paths.generate"):
+        loadings = None if correlation is None else factor_loadings(correlation, factorization)
+        uniforms = SobolGenerator(n_variables * n_times, seed=seed).generate(n_paths, start=start)
+        return brownians_from_uniforms(uniforms, n_variables, times, layout, dtype, out, loadings, ordering)
+
+
+def generate_brownians_in_chunks(
+        out,
+        n_variables: int,
+        times,
+        chunk_size: int,
+        start: int = 0,
+        n_processes: int = 1,
+        seed=None,
+        layout: BrownianLayout = BrownianLayout.PATH_MAJOR,
+        correlation=None,
+        factorization: Factorization = Factorization.CHOLESKY,
+        ordering: DimensionOrdering = DimensionOrdering.INTERLEAVED):
+    # Fills out (e.g. a np.memmap) chunk_size paths at a time, so only one chunk of uniforms is
+    # ever held in memory. The paths are the ones a single generate_brownians call would give.
+    path_axis = 0 if layout is BrownianLayout.PATH_MAJOR else 2
+    n_paths = out.shape[path_axis]
+    for chunk_start in range(0, n_paths, chunk_size):
+        chunk = slice(chunk_start, min(chunk_start + chunk_size, n_paths))
+        generate_brownians(
+            chunk.stop - chunk.start, n_variables, times, start + chunk_start, n_processes, seed, layout, out.dtype,
+            out[chunk] if path_axis == 0 else out[:, :, chunk], correlation, factorization, ordering
+        )
+    return out
@@ -1,5 +1,7 @@
 from datetime import date, timedelta
 
+import numpy as np
+
 
 class Day(date):
     def __init__(self, y: int, m: int, d: int):
@@ -21,3 +23,77 @@ class Day(date):
     def time_since(self, d: date) -> float:
         diff = date.__sub__(self, d)
         return diff.days / 365.25
+
+
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+class DayArray:
+    # Days held as int64 day numbers counted from 1970-01-01, the same numbering as datetime64[D],
+    # so arithmetic and year fractions for whole books or schedules are single array operations
+    def __init__(self, days):
+        if isinstance(days, DayArray):
+            day_numbers = days.day_numbers
+        else:
+            days = np.asarray(days)
+            if days.dtype.kind in "iu":
+                day_numbers = days
+            elif days.dtype.kind == "M":
+                day_numbers = days.astype("datetime64[D]").astype(np.int64)
+            else:
+                day_numbers = np.array([d.toordinal() - _EPOCH_ORDINAL for d in days.ravel()], np.int64).reshape(
+                    days.shape)
+        self.day_numbers = np.asarray(day_numbers, np.int64)
+
+    @classmethod
+    def schedule(cls, start: date, end: date, step: int = 1):
+        # Every step'th day from start up to and including end
+        first = start.toordinal() - _EPOCH_ORDINAL
+        last = end.toordinal() - _EPOCH_ORDINAL
+        return cls(np.arange(first, last + 1, step, dtype=np.int64))
+
+    def as_datetime64(self):
+        return self.day_numbers.astype("datetime64[D]")
+
+    def __len__(self):
+        return len(self.day_numbers)
+
+    def __getitem__(self, item):
+        day_numbers = self.day_numbers[item]
+        if np.ndim(day_numbers) == 0:
+            d = date.fromordinal(int(day_numbers) + _EPOCH_ORDINAL)
+            return Day(d.year, d.month, d.day)
+        return DayArray(day_numbers)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __eq__(self, other):
+        return self.day_numbers == _day_numbers(other)
+
+    def __add__(self, other):
+        return DayArray(self.day_numbers + _day_counts(other))
+
+    def __sub__(self, other):
+        # Days minus day counts are days, days minus days are day counts
+        if isinstance(other, (date, DayArray)) or np.asarray(other).dtype.kind == "M":
+            return self.day_numbers - _day_numbers(other)
+        return DayArray(self.day_numbers - _day_counts(other))
+
+    def time_since(self, d) -> np.ndarray:
+        return (self.day_numbers - _day_numbers(d)) / 365.25
+
+    def __repr__(self):
+        return f"DayArray({self.as_datetime64()})"
+
+
+def _day_numbers(days):
+    if isinstance(days, date):
+        return days.toordinal() - _EPOCH_ORDINAL
+    return DayArray(days).day_numbers
+
+
+def _day_counts(other):
+    if isinstance(other, timedelta):
+        return other.days
+    return np.asarray(other, np.int64)
@@ -0,0 +1,104 @@
+import json
+from time import perf_counter, time
+
+# Opt-in timers and counters. Nothing is recorded until a sink is installed with enable();
+# while disabled, timer() hands back a shared no-op context manager and count() returns at once.
+# Sinks are per process, so work farmed out to a process pool is not recorded.
+
+_sink = None
+
+
+class InMemorySink:
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+
+    def record_time(self, name: str, seconds: float):
+        calls, total = self.timers.get(name, (0, 0.0))
+        self.timers[name] = (calls + 1, total + seconds)
+
+    def record_count(self, name: str, n: int):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        return {
+            "timers": {name: {"calls": calls, "seconds": total} for name, (calls, total) in self.timers.items()},
+            "counters": dict(self.counters)
+        }
+
+    def reset(self):
+        self.timers.clear()
+        self.counters.clear()
+
+
+class JsonLinesSink:
+    # One JSON object per event, to a path (appended to) or an open text file
+    def __init__(self, file):
+        self._owns_file = isinstance(file, str)
+        self.file = open(file, "a") if self._owns_file else file
+
+    def _write(self, event: dict):
+        self.file.write(json.dumps(event) + "\n")
+
+    def record_time(self, name: str, seconds: float):
+        self._write({"type": "timer", "name": name, "seconds": seconds, "time": time()})
+
+    def record_count(self, name: str, n: int):
+        self._write({"type": "counter", "name": name, "count": n, "time": time()})
+
+    def close(self):
+        if self._owns_file:
+            self.file.close()
+
+
+def enable(sink):
+    global _sink
+    _sink = sink
+    return sink
+
+
+def disable():
+    global _sink
+    _sink = None
+
+
+def enabled() -> bool:
+    return _sink is not None
+
+
+class _Timer:
+    __slots__ = ("name", "started")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = perf_counter() - self.started
+        if _sink is not None:
+            _sink.record_time(self.name, elapsed)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(name: str):
+    return _NULL_TIMER if _sink is None else _Timer(name)
+
+
+def count(name: str, n: int = 1):
+    if _sink is not None:
+        _sink.record_count(name, n)
@@ -0,0 +1,130 @@
+from time import perf_counter
+
+import numpy as np
+
+
+class MonteCarloEstimate:
+    def __init__(self, value: float, std_err: float, n_paths: int):
+        self.value = value
+        self.std_err = std_err
+        self.n_paths = n_paths
+
+    def __repr__(self):
+        return f"MonteCarloEstimate(value={self.value}, std_err={self.std_err}, n_paths={self.n_paths})"
+
+
+def replicate_seeds(seed, n_replicates: int):
+    return np.random.SeedSequence(seed).spawn(n_replicates)
+
+
+def replicate_estimate(values, n_paths_per_replicate: int) -> MonteCarloEstimate:
+    values = np.asarray(values, float)
+    n_replicates = len(values)
+    if n_replicates < 2:
+        raise Exception(f"Need at least two replicates for an error estimate, got {n_replicates}")
+    return MonteCarloEstimate(
+        float(np.mean(values)),
+        float(np.std(values, ddof=1) / np.sqrt(n_replicates)),
+        n_paths_per_replicate * n_replicates
+    )
+
+
+def sample_estimate(samples, n_paths: int = None, ddof: int = 1) -> MonteCarloEstimate:
+    # Standard error from the sample variance; for quasi-random samples this is an upper bound.
+    # Control variate adjusted samples pass ddof=2, since fitting beta costs a degree of freedom.
+    samples = np.asarray(samples, float)
+    n_samples = len(samples)
+    return MonteCarloEstimate(
+        float(np.mean(samples)),
+        float(np.std(samples, ddof=ddof) / np.sqrt(n_samples)),
+        n_samples if n_paths is None else n_paths
+    )
+
+
+def control_variate_samples(samples, controls, control_mean: float):
+    # Regression estimator: beta is fitted on the same samples
+    samples = np.asarray(samples, float)
+    controls = np.asarray(controls, float)
+    control_deviations = controls - np.mean(controls)
+    control_variance = np.dot(control_deviations, control_deviations)
+    beta = np.dot(control_deviations, samples) / control_variance if control_variance > 0.0 else 0.0
+    return samples - beta * (controls - control_mean)
+
+
+class RunningStats:
+    # Streaming mean and variance of samples added chunk by chunk (Chan et al. pairwise update),
+    # plus the mean of each chunk for batch-means error estimates
+    def __init__(self):
+        self.n_samples = 0
+        self.n_paths = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.chunk_means = []
+
+    def add(self, samples, n_paths: int = None):
+        samples = np.asarray(samples, float)
+        n_chunk = len(samples)
+        chunk_mean = float(np.mean(samples))
+        chunk_m2 = float(np.sum(np.square(samples - chunk_mean)))
+
+        n_total = self.n_samples + n_chunk
+        delta = chunk_mean - self.mean
+        self.mean += delta * n_chunk / n_total
+        self.m2 += chunk_m2 + delta * delta * self.n_samples * n_chunk / n_total
+        self.n_samples = n_total
+        self.n_paths += n_chunk if n_paths is None else n_paths
+        self.chunk_means.append(chunk_mean)
+
+    @property
+    def n_chunks(self):
+        return len(self.chunk_means)
+
+    @property
+    def variance(self):
+        return self.m2 / (self.n_samples - 1) if self.n_samples > 1 else np.inf
+
+    @property
+    def std_err(self):
+        return float(np.sqrt(self.variance / self.n_samples)) if self.n_samples > 1 else np.inf
+
+    @property
+    def chunk_std_err(self):
+        # Treats every chunk as one independent estimate, which is what a path-wise
+        # regression (as in Longstaff-Schwartz) leaves us with
+        if self.n_chunks < 2:
+            return np.inf
+        return float(np.std(self.chunk_means, ddof=1) / np.sqrt(self.n_chunks))
+
+    def estimate(self, chunk_errors: bool = False) -> MonteCarloEstimate:
+        return MonteCarloEstimate(
+            float(self.mean), self.chunk_std_err if chunk_errors else self.std_err, self.n_paths
+        )
+
+
+def streaming_estimate(
+        chunk_samples,
+        chunk_size: int,
+        tol: float = None,
+        max_time: float = None,
+        max_paths: int = None,
+        min_chunks: int = 2,
+        chunk_errors: bool = False) -> MonteCarloEstimate:
+    # chunk_samples(start, n_paths) returns the samples for paths start .. start + n_paths - 1.
+    # Stops once the standard error is at most tol, max_time seconds have passed or max_paths
+    # paths have been used, whichever comes first.
+    if tol is None and max_time is None and max_paths is None:
+        raise Exception("Streaming Monte Carlo needs at least one of tol, max_time or max_paths")
+
+    stats = RunningStats()
+    started = perf_counter()
+    while max_paths is None or stats.n_paths < max_paths:
+        n_paths = chunk_size if max_paths is None else min(chunk_size, max_paths - stats.n_paths)
+        stats.add(chunk_samples(stats.n_paths, n_paths), n_paths)
+
+        std_err = stats.chunk_std_err if chunk_errors else stats.std_err
+        if tol is not None and stats.n_chunks >= min_chunks and std_err <= tol:
+            break
+        if max_time is not None and perf_counter() - started >= max_time:
+            break
+
+    return stats.estimate(chunk_errors)
@@ -1,5 +1,7 @@
 from enum import Enum
 
+import numpy as np
+
 
 class OptionRight(Enum):
     CALL = 1
@@ -10,3 +12,12 @@ class OptionRight(Enum):
 class ExerciseStyle(Enum):
     EUROPEAN = 1,
     AMERICAN = 2
+
+
+class AmericanMethod(Enum):
+    CRANK_NICHOLSON = 1
+    BARONE_ADESI_WHALEY = 2
+
+
+def right_codes(rights) -> np.ndarray:
+    return np.array([right.value for right in rights], int)
@@ -1,12 +1,31 @@
+from enum import Enum
+from functools import lru_cache
+
 from scipy.stats import norm
 
 from numpy import sqrt, log, exp
 import numpy as np
+
 from scipy.interpolate import CubicSpline
+from scipy.linalg import lapack
+from scipy.special import ndtr
 
+from models import instrumentation
 from models.brownian_generator import generate_brownians
+from models.monte_carlo import MonteCarloEstimate, replicate_seeds, replicate_estimate, sample_estimate, \
+    control_variate_samples, streaming_estimate
 from models.option import ExerciseStyle, OptionRight
 
+_CALL = OptionRight.CALL.value
+_PUT = OptionRight.PUT.value
+_STRADDLE = OptionRight.STRADDLE.value
+
+
+class ControlVariate(Enum):
+    NONE = 1
+    FORWARD = 2  # the simulated forward price, whose mean is the input forward
+    VANILLA = 3  # an at-the-money-forward call priced with black_scholes
+
 
 def intrinsic_value(right: OptionRight, strike: float, fwd_price: float):
     if right is OptionRight.CALL:
@@ -39,6 +58,369 @@ def black_scholes(
     raise Exception(f"Unexpected option right {right}")
 
 
+class OptionGreeks:
+    def __init__(self, value, delta, gamma, vega, theta):
+        self.value = value
+        self.delta = delta
+        self.gamma = gamma
+        self.vega = vega
+        self.theta = theta
+
+
+def check_right_codes(rights):
+    # Raises unless every element is a right code, OptionRight.value
+    if not np.all((rights == _CALL) | (rights == _PUT) | (rights == _STRADDLE)):
+        raise Exception(f"Unexpected option rights {np.unique(rights)}")
+
+
+def _payoff_weights(rights):
+    # Every payoff is call_weight * max(F - K, 0) + forward_weight * (F - K)
+    call_weight = np.where(rights == _STRADDLE, 2.0, 1.0)
+    forward_weight = np.where(rights == _CALL, 0.0, -1.0)
+    return call_weight, forward_weight
+
+
+def intrinsic_values(rights, strikes, fwd_prices):
+    rights, strikes, fwd_prices = np.broadcast_arrays(rights, strikes, fwd_prices)
+    check_right_codes(rights)
+    call = np.maximum(fwd_prices - strikes, 0.0)
+    put = np.maximum(strikes - fwd_prices, 0.0)
+    return np.where(rights == _CALL, call, np.where(rights == _PUT, put, call + put))
+
+
+def black_scholes_values(rights, strikes, fwd_prices, sigmas, ts):
+    return black_scholes_greeks(rights, strikes, fwd_prices, sigmas, ts).value
+
+
+def black_scholes_greeks(rights, strikes, fwd_prices, sigmas, ts) -> OptionGreeks:
+    # Undiscounted Black-76 values and sensitivities; theta is per year of calendar time.
+    # Options with no remaining variance get their intrinsic value and step-function delta.
+    rights, strikes, fwd_prices, sigmas, ts = np.broadcast_arrays(
+        rights, np.asarray(strikes, float), np.asarray(fwd_prices, float), np.asarray(sigmas, float),
+        np.asarray(ts, float)
+    )
+    check_right_codes(rights)
+
+    sqrt_t = np.sqrt(np.maximum(ts, 0.0))
+    vol = sigmas * sqrt_t
+    live = vol > 0.0
+    safe_vol = np.where(live, vol, 1.0)
+    safe_sqrt_t = np.where(live, sqrt_t, 1.0)
+
+    d1 = np.where(live, (log(fwd_prices / strikes) + 0.5 * safe_vol * safe_vol) / safe_vol, 0.0)
+    d2 = d1 - safe_vol
+    n1 = np.where(live, ndtr(d1), np.where(fwd_prices > strikes, 1.0, np.where(fwd_prices < strikes, 0.0, 0.5)))
+    n2 = np.where(live, ndtr(d2), n1)
+    pdf1 = np.where(live, np.exp(-0.5 * d1 * d1) / np.sqrt(2.0 * np.pi), 0.0)
+
+    call = n1 * fwd_prices - n2 * strikes
+    put = (1.0 - n2) * strikes - (1.0 - n1) * fwd_prices
+    is_call = rights == _CALL
+    is_put = rights == _PUT
+    value = np.where(live, np.where(is_call, call, np.where(is_put, put, call + put)),
+                     intrinsic_values(rights, strikes, fwd_prices))
+
+    n_legs = np.where(rights == _STRADDLE, 2.0, 1.0)
+    delta = np.where(is_call, n1, np.where(is_put, n1 - 1.0, 2.0 * n1 - 1.0))
+    gamma = n_legs * pdf1 / (fwd_prices * safe_vol)
+    vega = n_legs * fwd_prices * pdf1 * sqrt_t
+    theta = -n_legs * fwd_prices * pdf1 * sigmas / (2.0 * safe_sqrt_t)
+
+    return OptionGreeks(value, delta, gamma, vega, theta)
+
+
+def implied_vols(rights, prices, strikes, fwd_prices, ts, tol: float = 1e-12, max_iterations: int = 20):
+    # Inverts undiscounted black_scholes prices. Puts and straddles are mapped to calls through
+    # parity, the Corrado-Miller approximation gives a starting total vol v = sigma * sqrt(t), and
+    # safeguarded Halley steps polish it. Returns the vols and a per-element convergence flag.
+    rights, prices, strikes, fwd_prices, ts = np.broadcast_arrays(
+        rights, np.asarray(prices, float), np.asarray(strikes, float), np.asarray(fwd_prices, float),
+        np.asarray(ts, float)
+    )
+    check_right_codes(rights)
+
+    forward_value = fwd_prices - strikes
+    calls = np.where(rights == _CALL, prices, np.where(rights == _PUT, prices + forward_value,
+                                                       0.5 * (prices + forward_value)))
+    valid = (ts > 0.0) & (calls > np.maximum(forward_value, 0.0)) & (calls < fwd_prices)
+    calls = np.where(valid, calls, np.maximum(forward_value, 0.0) + 0.5 * fwd_prices)
+    log_moneyness = log(fwd_prices / strikes)
+
+    x = calls - 0.5 * forward_value
+    v = sqrt(2.0 * np.pi) / (fwd_prices + strikes) * (
+        x + np.sqrt(np.maximum(x * x - forward_value * forward_value / np.pi, 0.0)))
+    v = np.where(v > 0.0, v, sqrt(2.0 * np.pi) * calls / fwd_prices)
+
+    lower = np.zeros_like(v)
+    upper = np.full_like(v, np.inf)
+    converged = np.zeros(v.shape, bool)
+    with np.errstate(over="ignore", divide="ignore", invalid="ignore"):
+        v, converged = _halley_implied_vols(
+            v, lower, upper, converged, valid, calls, strikes, fwd_prices, log_moneyness, tol, max_iterations
+        )
+
+    converged &= valid
+    return np.where(valid, v / np.sqrt(np.where(valid, ts, 1.0)), np.nan), converged
+
+
+def _halley_implied_vols(v, lower, upper, converged, valid, calls, strikes, fwd_prices, log_moneyness, tol,
+                         max_iterations):
+    for _ in range(max_iterations):
+        d1 = log_moneyness / v + 0.5 * v
+        d2 = d1 - v
+        error = fwd_prices * ndtr(d1) - strikes * ndtr(d2) - calls
+        converged = np.abs(error) <= tol * fwd_prices
+        if np.all(converged | ~valid):
+            break
+
+        lower = np.where(error < 0.0, v, lower)
+        upper = np.where(error > 0.0, v, upper)
+
+        vega = fwd_prices * np.exp(-0.5 * d1 * d1) / sqrt(2.0 * np.pi)
+        newton_step = error / np.maximum(vega, 1e-300)
+        halley_denominator = 1.0 - 0.5 * newton_step * d1 * d2 / v
+        step = np.where(halley_denominator > 0.5, newton_step / halley_denominator, newton_step)
+        proposal = v - step
+
+        bisection = np.where(np.isinf(upper), 2.0 * v, 0.5 * (lower + upper))
+        inside = np.isfinite(proposal) & (proposal > lower) & (proposal < upper)
+        v = np.where(converged, v, np.where(inside, proposal, bisection))
+
+    return v, converged
+
+
+# Calibration of the approximation against Crank-Nicolson (800 x 800 grid, 6 std devs): the largest
+# |BAW - CN| / max(CN, K / 100) over calls and puts with log(F / K) / sqrt(sigma^2 t) in [-3, 3], by r t
+# (rows) and sigma^2 t (columns). The error grows with both, so the largest corner of a cell bounds it.
+_BAW_RATE_TIMES = np.array([0.0, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5])
+_BAW_TOTAL_VARIANCES = np.array([0.0, 0.0025, 0.01, 0.025, 0.05, 0.1, 0.2, 0.35, 0.5])
+_BAW_ERRORS = np.array([
+    [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+    [0.0, 0.0007, 0.0012, 0.0017, 0.0021, 0.0026, 0.0034, 0.0041, 0.0048],
+    [0.0, 0.0019, 0.0030, 0.0042, 0.0051, 0.0064, 0.0082, 0.0100, 0.0116],
+    [0.0, 0.0033, 0.0051, 0.0070, 0.0086, 0.0107, 0.0136, 0.0165, 0.0193],
+    [0.0, 0.0064, 0.0098, 0.0134, 0.0162, 0.0200, 0.0254, 0.0307, 0.0365],
+    [0.0, 0.0108, 0.0161, 0.0218, 0.0264, 0.0324, 0.0410, 0.0494, 0.0598],
+    [0.0, 0.0156, 0.0230, 0.0304, 0.0367, 0.0449, 0.0567, 0.0681, 0.0844],
+    [0.0, 0.0256, 0.0376, 0.0473, 0.0568, 0.0693, 0.0872, 0.1057, 0.1351],
+    [0.0, 0.0356, 0.0525, 0.0634, 0.0770, 0.0944, 0.1168, 0.1462, 0.1797],
+    [0.0, 0.0516, 0.0802, 0.0988, 0.1199, 0.1466, 0.1808, 0.2255, 0.2524],
+    [0.0, 0.0735, 0.1141, 0.1552, 0.1868, 0.2263, 0.2805, 0.3292, 0.3644],
+])
+
+
+def barone_adesi_whaley_error_bounds(rate_times, total_variances):
+    # Calibrated relative error bound of barone_adesi_whaley_values for r t and sigma^2 t, in units
+    # of max(value, strike / 100). Infinite outside the calibrated r t <= 0.5, sigma^2 t <= 0.5.
+    rate_times, total_variances = np.broadcast_arrays(
+        np.asarray(rate_times, float), np.asarray(total_variances, float)
+    )
+    inside = (rate_times >= 0.0) & (rate_times <= _BAW_RATE_TIMES[-1]) & (total_variances >= 0.0) & (
+            total_variances <= _BAW_TOTAL_VARIANCES[-1])
+    i_rate = np.clip(np.searchsorted(_BAW_RATE_TIMES, rate_times), 1, len(_BAW_RATE_TIMES) - 1)
+    i_variance = np.clip(np.searchsorted(_BAW_TOTAL_VARIANCES, total_variances), 1, len(_BAW_TOTAL_VARIANCES) - 1)
+    return np.where(inside, _BAW_ERRORS[i_rate, i_variance], np.inf)
+
+
+def barone_adesi_whaley_values(rights, strikes, fwd_prices, sigmas, ts, rs, tol: float = 0.01,
+                               newton_tol: float = 1e-8, max_iterations: int = 50):
+    # Discounted American futures option values from the quadratic approximation with cost of
+    # carry b = 0. Puts use put-call symmetry, P(F, K) = C(K, F) when b = 0, so only the call's
+    # critical price is solved for, with Newton steps from the Barone-Adesi-Whaley seed. Straddles
+    # have a two-sided exercise region the approximation does not cover and come back as NaN.
+    #
+    # Returns the values and a per-element converged flag: the critical price converged, the value
+    # respects the no-arbitrage bounds intrinsic, European <= American <= undiscounted European, and
+    # the calibrated error bound (barone_adesi_whaley_error_bounds) is at most tol. With the default
+    # tol of 1% that domain is r t <= 0.02 for sigma^2 t up to 0.35 and r t <= 0.03 for sigma^2 t up
+    # to 0.05; longer dated or higher rate options are left to Crank-Nicolson. Options without early
+    # exercise (r <= 0 or no volatility) get the exact European value and are always converged.
+    rights, strikes, fwd_prices, sigmas, ts, rs = np.broadcast_arrays(
+        rights, np.asarray(strikes, float), np.asarray(fwd_prices, float), np.asarray(sigmas, float),
+        np.asarray(ts, float), np.asarray(rs, float)
+    )
+    check_right_codes(rights)
+
+    puts = rights == _PUT
+    spots = np.where(puts, strikes, fwd_prices)
+    calls_strikes = np.where(puts, fwd_prices, strikes)
+    disc = np.exp(-rs * ts)
+    vols = sigmas * np.sqrt(np.maximum(ts, 0.0))
+    european = disc * black_scholes_values(_CALL, calls_strikes, spots, sigmas, ts)
+
+    # Early exercise of a futures option only pays with positive rates and some volatility
+    early = (rights != _STRADDLE) & (rs > 0.0) & (vols > 0.0)
+    with np.errstate(over="ignore", divide="ignore", invalid="ignore"):
+        american, converged = _barone_adesi_whaley_calls(
+            spots, calls_strikes, sigmas, vols, rs, disc, european, early, newton_tol, max_iterations
+        )
+
+    values = np.where(early, american, np.where(vols > 0.0, european, intrinsic_values(_CALL, calls_strikes, spots)))
+    lower = np.maximum(european, intrinsic_values(_CALL, calls_strikes, spots))
+    upper = european / disc
+    slack = newton_tol * strikes
+    converged &= (american >= lower - slack) & (american <= upper + slack)
+    converged &= barone_adesi_whaley_error_bounds(rs * ts, vols * vols) <= tol
+
+    straddles = rights == _STRADDLE
+    return np.where(straddles, np.nan, values), np.where(early, converged, ~straddles)
+
+
+def _barone_adesi_whaley_calls(spots, strikes, sigmas, vols, rs, disc, european, early, tol, max_iterations):
+    m = 2.0 * rs / (sigmas * sigmas)
+    q2 = 0.5 * (1.0 + np.sqrt(1.0 + 4.0 * m / (1.0 - disc)))
+    q2_infinite = 0.5 * (1.0 + np.sqrt(1.0 + 4.0 * m))
+    critical_infinite = strikes / (1.0 - 1.0 / q2_infinite)
+    critical = strikes + (critical_infinite - strikes) * (
+            1.0 - np.exp(-2.0 * vols * strikes / (critical_infinite - strikes)))
+
+    converged = np.zeros(spots.shape, bool)
+    for _ in range(max_iterations):
+        d1 = log(critical / strikes) / vols + 0.5 * vols
+        n1 = ndtr(d1)
+        call = disc * (critical * n1 - strikes * ndtr(d1 - vols))
+        rhs = call + (1.0 - disc * n1) * critical / q2
+        converged = np.abs(critical - strikes - rhs) <= tol * strikes
+        if np.all(converged | ~early):
+            break
+        slope = disc * n1 * (1.0 - 1.0 / q2) + (1.0 - disc * np.exp(-0.5 * d1 * d1) / (sqrt(2.0 * np.pi) * vols)) / q2
+        critical = np.where(converged, critical, (strikes + rhs - slope * critical) / (1.0 - slope))
+
+    d1 = log(critical / strikes) / vols + 0.5 * vols
+    a2 = critical / q2 * (1.0 - disc * ndtr(d1))
+    american = np.where(spots < critical, european + a2 * np.power(spots / critical, q2), spots - strikes)
+    return american, converged & np.isfinite(american)
+
+
+class CrankNicholsonOperator:
+    # Both Crank-Nicolson matrices are tridiagonal, with identity rows at the boundaries.
+    # The implicit side is LU-factorized once and reused for every time step.
+    def __init__(self, n: int, dz: float, dt: float):
+        a = 1.0 / (dz * dz)
+        self.n = n
+        self.off_diagonal = a / 2
+        self.explicit_diagonal = 2.0 / dt - a
+
+        lower = np.full((n - 1,), -a / 2)
+        diagonal = np.full((n,), 2.0 / dt + a)
+        upper = np.full((n - 1,), -a / 2)
+        lower[n - 2] = 0.0
+        diagonal[0] = 1.0
+        diagonal[n - 1] = 1.0
+        upper[0] = 0.0
+
+        lower, diagonal, upper, upper2, pivots, info = lapack.dgttrf(lower, diagonal, upper)
+        if info != 0:
+            raise Exception(f"Crank-Nicolson matrix is singular, LAPACK info {info}")
+        self.factors = (lower, diagonal, upper, upper2, pivots)
+
+    def apply_explicit(self, vec, out):
+        np.add(vec[:-2], vec[2:], out=out[1:-1])
+        out[1:-1] *= self.off_diagonal
+        out[1:-1] += self.explicit_diagonal * vec[1:-1]
+        out[0] = vec[0]
+        out[-1] = vec[-1]
+        return out
+
+    def solve(self, rhs):
+        x, info = lapack.dgttrs(*self.factors, rhs, overwrite_b=1)
+        if info != 0:
+            raise Exception(f"Crank-Nicolson solve failed, LAPACK info {info}")
+        return x
+
+
+@lru_cache(maxsize=128)
+def crank_nicholson_operator(n: int, dz: float, dt: float) -> CrankNicholsonOperator:
+    return CrankNicholsonOperator(n, dz, dt)
+
+
+def _option_columns(rights, strikes, fwd_prices):
+    rights, strikes, fwd_prices = np.broadcast_arrays(
+        np.atleast_1d(rights), np.atleast_1d(np.asarray(strikes, float)), np.atleast_1d(np.asarray(fwd_prices, float))
+    )
+    check_right_codes(rights)
+    return rights, strikes, fwd_prices
+
+
+def _crank_nicholson_layers(
+        rights,
+        ex_style: ExerciseStyle,
+        strikes,
+        sigma: float,
+        r: float,
+        time_to_expiry: float,
+        n: int, n_times: int, std_devs: float):
+    # Returns the relative price grid exp(z * sigma) with the value columns at t = 0 and t = dt
+    with instrumentation.timer("cn.solve"):
+        layers = _crank_nicholson_diffusion(rights, ex_style, strikes, sigma, r, time_to_expiry, n, n_times, std_devs)
+    instrumentation.count("cn.columns", len(rights))
+    return layers
+
+
+def _crank_nicholson_diffusion(
+        rights,
+        ex_style: ExerciseStyle,
+        strikes,
+        sigma: float,
+        r: float,
+        time_to_expiry: float,
+        n: int, n_times: int, std_devs: float):
+    n_options = len(rights)
+
+    dz = 2.0 * std_devs / (n - 1.0)
+    dt = time_to_expiry / (n_times - 1.0)
+
+    zs = np.arange(-std_devs, std_devs + dz / 2.0, dz)
+    disc = exp(-r * dt)
+    call_weight, forward_weight = _payoff_weights(rights)
+
+    # Column i holds prices strikes[i] * relative_prices * exp(-sigma^2 t / 2)
+    relative_prices = np.exp(zs * sigma)
+    prices_at_zero = np.outer(relative_prices, strikes)
+    prices = np.zeros((n, n_options), float, order="F")
+    moneyness = np.zeros((n, n_options), float, order="F")
+    intrinsics = np.zeros((n, n_options), float, order="F")
+
+    def intrinsic_on_grid(t):
+        np.multiply(prices_at_zero, exp(-0.5 * sigma * sigma * t), out=prices)
+        np.subtract(prices, strikes, out=moneyness)
+        np.maximum(moneyness, 0.0, out=intrinsics)
+        np.multiply(intrinsics, call_weight, out=intrinsics)
+        np.multiply(moneyness, forward_weight, out=moneyness)
+        np.add(intrinsics, moneyness, out=intrinsics)
+        return intrinsics
+
+    operator = crank_nicholson_operator(n, dz, dt)
+
+    # This is the vector at time n_times - 2 - can use european values here
+    np.multiply(prices_at_zero, exp(-0.5 * sigma * sigma * (time_to_expiry - dt)), out=prices)
+    vec = np.asfortranarray(black_scholes_values(rights, strikes, prices, sigma, dt))
+    work = np.zeros((n, n_options), float, order="F")
+
+    vec_at_dt = vec.copy() if n_times == 3 else None
+
+    # Now diffuse the remaining n_times - 2 steps
+    for i_near_time in range(n_times - 3, -1, -1):
+        t_near = i_near_time * dt
+        operator.apply_explicit(vec, work)
+        # dgttrs overwrites contiguous float64 input in place; keep its result in case it copies
+        work = operator.solve(work)
+        work *= disc
+        vec, work = work, vec
+
+        intrinsic_on_grid(t_near)
+        vec[0] = intrinsics[0]
+        vec[n - 1] = intrinsics[n - 1]
+
+        if ex_style == ExerciseStyle.AMERICAN:
+            np.maximum(vec, intrinsics, out=vec)
+
+        if i_near_time == 1:
+            vec_at_dt = vec.copy()
+
+    return relative_prices, vec, vec_at_dt
+
+
 def crank_nicholson_value(
         right: OptionRight,
         ex_style: ExerciseStyle,
@@ -48,75 +430,189 @@ def crank_nicholson_value(
         r: float,
         time_to_expiry: float,
         n: int, n_times: int, std_devs: float) -> float:
-    dz = 2.0 * std_devs / (n - 1.0)
+    values = crank_nicholson_values(
+        right.value, ex_style, strike, fwd_price, sigma, r, time_to_expiry, n, n_times, std_devs
+    )
+    return float(values[0])
+
+
+def _evaluate_spline_columns(cs: CubicSpline, xs, nu: int = 0):
+    # Evaluates column i of a vector-valued spline, or its nu'th derivative, at xs[i],
+    # extrapolating like CubicSpline
+    i_column = np.arange(len(xs))
+    i_interval = np.clip(np.searchsorted(cs.x, xs) - 1, 0, len(cs.x) - 2)
+    dx = xs - cs.x[i_interval]
+    c = cs.c[:, i_interval, i_column]
+    if nu == 0:
+        return ((c[0] * dx + c[1]) * dx + c[2]) * dx + c[3]
+    if nu == 1:
+        return (3.0 * c[0] * dx + 2.0 * c[1]) * dx + c[2]
+    if nu == 2:
+        return 6.0 * c[0] * dx + 2.0 * c[1]
+    raise Exception(f"Unsupported derivative order {nu}")
+
+
+def crank_nicholson_grid_values(
+        rights,
+        ex_style: ExerciseStyle,
+        strikes,
+        sigma: float,
+        r: float,
+        time_to_expiry: float,
+        n: int, n_times: int, std_devs: float):
+    # The t = 0 solution on the grid itself: the relative prices F / K = exp(z * sigma) and one
+    # column of discounted values per option, to interpolate at any forward
+    rights, strikes = np.broadcast_arrays(np.atleast_1d(rights), np.atleast_1d(np.asarray(strikes, float)))
+    check_right_codes(rights)
+    relative_prices, values, _ = _crank_nicholson_layers(
+        rights, ex_style, strikes, sigma, r, time_to_expiry, n, n_times, std_devs
+    )
+    return relative_prices, values
+
+
+def crank_nicholson_values(
+        rights,
+        ex_style: ExerciseStyle,
+        strikes,
+        fwd_prices,
+        sigma: float,
+        r: float,
+        time_to_expiry: float,
+        n: int, n_times: int, std_devs: float):
+    # Values a strip of options sharing sigma, r and expiry. The diffusion in z is the
+    # same for all of them, so each option is a column carried through one solve per step.
+    rights, strikes, fwd_prices = _option_columns(rights, strikes, fwd_prices)
+    relative_prices, values, _ = _crank_nicholson_layers(
+        rights, ex_style, strikes, sigma, r, time_to_expiry, n, n_times, std_devs
+    )
+
+    # A cubic spline is unchanged by rescaling x, so one spline over relative prices serves every strike
+    cs = CubicSpline(relative_prices, values)
+    return _evaluate_spline_columns(cs, fwd_prices / strikes)
+
+
+def crank_nicholson_greeks(
+        rights,
+        ex_style: ExerciseStyle,
+        strikes,
+        fwd_prices,
+        sigma: float,
+        r: float,
+        time_to_expiry: float,
+        n: int, n_times: int, std_devs: float,
+        sigma_bump: float = 1e-3) -> OptionGreeks:
+    # Delta and gamma come from the t = 0 spline, theta from the first grid layer after it.
+    # Vega needs one bumped solve, which reuses the cached operator as the grid does not depend on sigma.
+    if n_times < 3:
+        raise Exception(f"Crank-Nicolson Greeks need at least three time layers for theta, got n_times={n_times}")
+    rights, strikes, fwd_prices = _option_columns(rights, strikes, fwd_prices)
+    relative_prices, values, values_at_dt = _crank_nicholson_layers(
+        rights, ex_style, strikes, sigma, r, time_to_expiry, n, n_times, std_devs
+    )
     dt = time_to_expiry / (n_times - 1.0)
+    xs = fwd_prices / strikes
 
-    def diffusion_matrices():
-        a = 1.0 / (dz * dz)
+    cs = CubicSpline(relative_prices, values)
+    value = _evaluate_spline_columns(cs, xs)
+    delta = _evaluate_spline_columns(cs, xs, nu=1) / strikes
+    gamma = _evaluate_spline_columns(cs, xs, nu=2) / (strikes * strikes)
 
-        m1 = np.zeros((n, n), float)
-        np.fill_diagonal(m1[1:n - 1], a / 2)
-        np.fill_diagonal(m1[1:n - 1, 1:], 2.0 / dt - a)
-        np.fill_diagonal(m1[1:, 2:], a / 2)
-        m1[0, 0] = 1.0
-        m1[n - 1, n - 1] = 1.0
+    cs_at_dt = CubicSpline(relative_prices * exp(-0.5 * sigma * sigma * dt), values_at_dt)
+    theta = (_evaluate_spline_columns(cs_at_dt, xs) - value) / dt
 
-        m2 = np.zeros((n, n), float)
-        np.fill_diagonal(m2[1:n - 1], -a / 2)
-        np.fill_diagonal(m2[1:n - 1, 1:], 2.0 / dt + a)
-        np.fill_diagonal(m2[1:, 2:], -a / 2)
-        m2[0, 0] = 1.0
-        m2[n - 1, n - 1] = 1.0
+    bumped_value = crank_nicholson_values(
+        rights, ex_style, strikes, fwd_prices, sigma + sigma_bump, r, time_to_expiry, n, n_times, std_devs
+    )
+    vega = (bumped_value - value) / sigma_bump
 
-        return m1, m2
+    return OptionGreeks(value, delta, gamma, vega, theta)
 
-    zs = np.arange(-std_devs, std_devs + dz / 2.0, dz)
-    z0 = zs[0]
-    zn = zs[n - 1]
 
-    (m1, m2) = diffusion_matrices()
+def _terminal_prices(fwd_price: float, sigma: float, time_to_expiry: float, brownians):
+    return fwd_price * np.exp(sigma * brownians - 0.5 * sigma * sigma * time_to_expiry)
 
-    def diffuse(vec, next_low_value, next_high_value):
-        v1 = np.matmul(m1, vec)
-        v2 = np.linalg.solve(m2, v1) * exp(-r * dt)
-        v2[0] = next_low_value
-        v2[n - 1] = next_high_value
-        return v2
 
-    def price(z, t):
-        p = strike * exp(z * sigma - 0.5 * sigma * sigma * t)
-        return p
+def _european_samples(
+        right: OptionRight,
+        strike: float,
+        fwd_price: float,
+        sigma: float,
+        time_to_expiry: float,
+        brownians,
+        antithetic: bool,
+        control_variate: ControlVariate):
+    # Undiscounted. With antithetic sampling each brownian is paired with its reflection and
+    # the pair average is one sample, so payoffs and controls are averaged the same way.
+    prices = _terminal_prices(fwd_price, sigma, time_to_expiry, brownians)
+    if antithetic:
+        prices = np.stack([prices, _terminal_prices(fwd_price, sigma, time_to_expiry, -brownians)])
+    instrumentation.count("mc.paths", prices.size)
 
-    def undiscounted_bs(z, t):
-        return black_scholes(right, strike, price(z, t), sigma, time_to_expiry - t)
+    payoffs = intrinsic_values(right.value, strike, prices)
+    if antithetic:
+        payoffs = np.mean(payoffs, axis=0)
 
-    def intrinsic(z, t):
-        return intrinsic_value(right, strike, price(z, t))
+    if control_variate is ControlVariate.NONE:
+        return payoffs
 
-    def lower_bound(t):
-        return intrinsic(z0, t)
+    if control_variate is ControlVariate.FORWARD:
+        controls = prices
+        control_mean = fwd_price
+    elif control_variate is ControlVariate.VANILLA:
+        # At-the-money-forward call: its price is known in closed form and it stays correlated
+        # with the payoff for any strike, unlike the option itself which would make the estimate trivial
+        controls = np.maximum(prices - fwd_price, 0.0)
+        control_mean = black_scholes(OptionRight.CALL, fwd_price, fwd_price, sigma, time_to_expiry)
+    else:
+        raise Exception(f"Unexpected control variate {control_variate}")
 
-    def upper_bound(t):
-        return intrinsic(zn, t)
+    if antithetic:
+        controls = np.mean(controls, axis=0)
+    return control_variate_samples(payoffs, controls, control_mean)
 
-    # This is the vector at time n_times - 2 - can use european values here
-    def penultimate_value(z):
-        return undiscounted_bs(z, time_to_expiry - dt)
 
-    vec = penultimate_value(zs)
+def _european_estimate(
+        right: OptionRight,
+        strike: float,
+        fwd_price: float,
+        sigma: float,
+        time_to_expiry: float,
+        brownians,
+        antithetic: bool,
+        control_variate: ControlVariate) -> MonteCarloEstimate:
+    samples = _european_samples(right, strike, fwd_price, sigma, time_to_expiry, brownians, antithetic,
+                                control_variate)
+    return sample_estimate(
+        samples, 2 * len(brownians) if antithetic else len(brownians),
+        ddof=1 if control_variate is ControlVariate.NONE else 2
+    )
+
 
-    # Now diffuse the remaining n_times - 2 steps
-    for i_near_time in range(n_times - 3, -1, -1):
-        t_near = i_near_time * dt
-        vec = diffuse(vec, lower_bound(t_near), upper_bound(t_near))
+def _discounted(estimate: MonteCarloEstimate, disc: float) -> MonteCarloEstimate:
+    return MonteCarloEstimate(estimate.value * disc, estimate.std_err * disc, estimate.n_paths)
 
-        if ex_style == ExerciseStyle.AMERICAN:
-            intrinsics = list(map(lambda z: intrinsic(z, t_near), zs))
-            vec = np.maximum(vec, intrinsics)
 
-    prices = list(map(lambda z: price(z, 0), zs))
-    cs = CubicSpline(prices, vec)
-    return np.asscalar(cs(fwd_price))
+def monte_carlo_european_estimate(
+        right: OptionRight,
+        strike: float,
+        fwd_price: float,
+        sigma: float,
+        r: float,
+        time_to_expiry: float,
+        n_paths: int,
+        n_processes: int = 1,
+        antithetic: bool = False,
+        control_variate: ControlVariate = ControlVariate.NONE) -> MonteCarloEstimate:
+    # The standard error treats the Sobol points as independent, so it overstates the QMC error;
+    # use randomized_monte_carlo_european_value for an unbiased error bar
+    n_brownians = n_paths // 2 if antithetic else n_paths
+    brownians = generate_brownians(
+        n_brownians, n_variables=1, times=np.array([time_to_expiry]), n_processes=n_processes
+    )[:, 0, 0]
+
+    estimate = _european_estimate(right, strike, fwd_price, sigma, time_to_expiry, brownians, antithetic,
+                                  control_variate)
+    return _discounted(estimate, exp(-r * time_to_expiry))
 
 
 def monte_carlo_european_value(
@@ -126,13 +622,109 @@ def monte_carlo_european_value(
         sigma: float,
         r: float,
         time_to_expiry: float,
-        n_paths: int) -> float:
-    def to_payoff(z: float):
-        price = fwd_price * exp(z * sigma - 0.5 * sigma * sigma * time_to_expiry)
-        return intrinsic_value(right, strike, price)
+        n_paths: int,
+        n_processes: int = 1,
+        antithetic: bool = False,
+        control_variate: ControlVariate = ControlVariate.NONE) -> float:
+    return monte_carlo_european_estimate(
+        right, strike, fwd_price, sigma, r, time_to_expiry, n_paths, n_processes, antithetic, control_variate
+    ).value
+
+
+def monte_carlo_european_greeks(
+        right: OptionRight,
+        strike: float,
+        fwd_price: float,
+        sigma: float,
+        r: float,
+        time_to_expiry: float,
+        n_paths: int,
+        n_processes: int = 1,
+        antithetic: bool = False) -> OptionGreeks:
+    # Discounted value and Greeks from one set of paths. Delta, vega and theta differentiate
+    # each path's payoff (pathwise), which is fine for the Lipschitz vanilla payoffs. The payoff
+    # derivative is a step, so gamma uses the likelihood ratio of the lognormal density instead.
+    n_brownians = n_paths // 2 if antithetic else n_paths
+    brownians = generate_brownians(
+        n_brownians, n_variables=1, times=np.array([time_to_expiry]), n_processes=n_processes
+    )[:, 0, 0]
+    if antithetic:
+        brownians = np.concatenate([brownians, -brownians])
+
+    prices = _terminal_prices(fwd_price, sigma, time_to_expiry, brownians)
+    payoffs = intrinsic_values(right.value, strike, prices)
+    call_weight, forward_weight = _payoff_weights(right.value)
+    slopes = call_weight * (prices > strike) + forward_weight
+
+    sqrt_t = sqrt(time_to_expiry)
+    z = brownians / sqrt_t
+    disc = exp(-r * time_to_expiry)
+    value = disc * np.mean(payoffs)
+    delta = disc * np.mean(slopes * prices) / fwd_price
+    vega = disc * np.mean(slopes * prices * (brownians - sigma * time_to_expiry))
+    gamma = disc * np.mean(payoffs * (z * z - 1.0 - sigma * sqrt_t * z)) / (
+            fwd_price * fwd_price * sigma * sigma * time_to_expiry)
+    d_price_dt = prices * (0.5 * sigma * z / sqrt_t - 0.5 * sigma * sigma)
+    theta = r * value - disc * np.mean(slopes * d_price_dt)
+    return OptionGreeks(float(value), float(delta), float(gamma), float(vega), float(theta))
+
+
+def randomized_monte_carlo_european_value(
+        right: OptionRight,
+        strike: float,
+        fwd_price: float,
+        sigma: float,
+        r: float,
+        time_to_expiry: float,
+        n_paths: int,
+        n_replicates: int = 8,
+        seed=None,
+        n_processes: int = 1,
+        antithetic: bool = False,
+        control_variate: ControlVariate = ControlVariate.NONE) -> MonteCarloEstimate:
+    disc = exp(-r * time_to_expiry)
+    n_brownians = n_paths // 2 if antithetic else n_paths
+    values = []
+    for replicate_seed in replicate_seeds(seed, n_replicates):
+        brownians = generate_brownians(
+            n_brownians, n_variables=1, times=np.array([time_to_expiry]), n_processes=n_processes,
+            seed=replicate_seed
+        )[:, 0, 0]
+        estimate = _european_estimate(right, strike, fwd_price, sigma, time_to_expiry, brownians, antithetic,
+                                      control_variate)
+        values.append(estimate.value * disc)
 
-    brownians = generate_brownians(n_paths, n_variables=1, times=np.array([time_to_expiry]))[:, 0, 0]
+    return replicate_estimate(values, n_paths)
+
+
+def streaming_monte_carlo_european_value(
+        right: OptionRight,
+        strike: float,
+        fwd_price: float,
+        sigma: float,
+        r: float,
+        time_to_expiry: float,
+        tol: float = None,
+        max_time: float = None,
+        max_paths: int = None,
+        chunk_size: int = 4096,
+        antithetic: bool = False,
+        control_variate: ControlVariate = ControlVariate.NONE) -> MonteCarloEstimate:
+    # Pulls chunk_size paths at a time from the same Sobol sequence monte_carlo_european_estimate
+    # uses, so memory is bounded by the chunk and a run to max_paths sees the same paths.
+    # tol is on the discounted value.
+    if antithetic and (chunk_size % 2 or (max_paths or 0) % 2):
+        raise Exception("Antithetic sampling needs an even chunk_size and max_paths")
 
-    payoffs = np.vectorize(to_payoff)(brownians)
     disc = exp(-r * time_to_expiry)
-    return np.mean(payoffs) * disc
+    times = np.array([time_to_expiry])
+
+    def chunk_samples(start: int, n_paths: int):
+        if antithetic:
+            start, n_paths = start // 2, n_paths // 2
+        brownians = generate_brownians(n_paths, n_variables=1, times=times, start=start)[:, 0, 0]
+        return _european_samples(
+            right, strike, fwd_price, sigma, time_to_expiry, brownians, antithetic, control_variate
+        ) * disc
+
+    return streaming_estimate(chunk_samples, chunk_size, tol, max_time, max_paths)
@@ -1,8 +1,24 @@
-from models.option_calcs import intrinsic_value, black_scholes, crank_nicholson_value, monte_carlo_european_value
-from models.option import OptionRight, ExerciseStyle
+import numpy as np
+
+from models.option_calcs import intrinsic_value, black_scholes, crank_nicholson_value, \
+    monte_carlo_european_estimate, monte_carlo_european_greeks, black_scholes_greeks, black_scholes_values, \
+    crank_nicholson_greeks, ControlVariate, barone_adesi_whaley_values
+from models.option import AmericanMethod, OptionRight, ExerciseStyle
 from models.day import Day
 from numpy import exp
 
+_american_method = AmericanMethod.CRANK_NICHOLSON
+
+
+def set_american_method(method: AmericanMethod):
+    # Method OptionInstrument.value uses for American options when none is passed
+    global _american_method
+    _american_method = method
+
+
+def default_american_method() -> AmericanMethod:
+    return _american_method
+
 
 class OptionInstrument:
     def __init__(self, strike: float, right: OptionRight, expiry: Day, ex_style: ExerciseStyle):
@@ -16,6 +32,8 @@ class OptionInstrument:
 
     def undiscounted_european_value(self, market_day: Day, fwd_price: float, sigma: float):
         t = self.expiry.time_since(market_day)
+        if np.ndim(fwd_price) > 0 or np.ndim(sigma) > 0:
+            return black_scholes_values(self.right.value, self.strike, fwd_price, sigma, t)
         return black_scholes(self.right, self.strike, fwd_price, sigma, t)
 
     def european_value(self, market_day: Day, fwd_price: float, sigma: float, r: float):
@@ -23,9 +41,57 @@ class OptionInstrument:
         disc = exp(-r * t)
         return self.undiscounted_european_value(market_day, fwd_price, sigma) * disc
 
-    def mc_european_value(self, market_day: Day, fwd_price: float, sigma: float, r: float):
+    def european_greeks(self, market_day: Day, fwd_price: float, sigma: float, r: float):
+        t = self.expiry.time_since(market_day)
+        disc = exp(-r * t)
+        greeks = black_scholes_greeks(self.right.value, self.strike, fwd_price, sigma, t)
+        greeks.theta = (greeks.theta + r * greeks.value) * disc
+        greeks.value = greeks.value * disc
+        greeks.delta = greeks.delta * disc
+        greeks.gamma = greeks.gamma * disc
+        greeks.vega = greeks.vega * disc
+        return greeks
+
+    def mc_european_value(
+            self,
+            market_day: Day,
+            fwd_price: float,
+            sigma: float,
+            r: float,
+            n_paths: int = 2048,
+            antithetic: bool = False,
+            control_variate: ControlVariate = ControlVariate.NONE):
+        return self.mc_european_estimate(
+            market_day, fwd_price, sigma, r, n_paths, antithetic, control_variate
+        ).value
+
+    def mc_european_estimate(
+            self,
+            market_day: Day,
+            fwd_price: float,
+            sigma: float,
+            r: float,
+            n_paths: int = 2048,
+            antithetic: bool = False,
+            control_variate: ControlVariate = ControlVariate.NONE):
+        t = self.expiry.time_since(market_day)
+        return monte_carlo_european_estimate(
+            self.right, self.strike, fwd_price, sigma, r, t, n_paths,
+            antithetic=antithetic, control_variate=control_variate
+        )
+
+    def mc_greeks(
+            self,
+            market_day: Day,
+            fwd_price: float,
+            sigma: float,
+            r: float,
+            n_paths: int = 2048,
+            antithetic: bool = False):
         t = self.expiry.time_since(market_day)
-        return monte_carlo_european_value(self.right, self.strike, fwd_price, sigma, r, t, n_paths=2048)
+        return monte_carlo_european_greeks(
+            self.right, self.strike, fwd_price, sigma, r, t, n_paths, antithetic=antithetic
+        )
 
     def cn_value(self, market_day: Day, fwd_price: float, sigma: float, r: float) -> float:
         t = self.expiry.time_since(market_day)
@@ -34,8 +100,42 @@ class OptionInstrument:
             100, 100, 4
         )
 
-    def value(self, market_day: Day, fwd_price: float, sigma: float, r: float) -> float:
+    def cn_greeks(self, market_day: Day, fwd_price: float, sigma: float, r: float):
+        t = self.expiry.time_since(market_day)
+        greeks = crank_nicholson_greeks(
+            self.right.value, self.ex_style, self.strike, fwd_price, sigma, r, t,
+            100, 100, 4
+        )
+        greeks.value, greeks.delta, greeks.gamma, greeks.vega, greeks.theta = (
+            float(greeks.value[0]), float(greeks.delta[0]), float(greeks.gamma[0]), float(greeks.vega[0]),
+            float(greeks.theta[0])
+        )
+        return greeks
+
+    def surface_value(self, market_day: Day, fwd_price: float, sigma: float, r: float, surface) -> float:
+        t = self.expiry.time_since(market_day)
+        return float(surface.option_values(self.right.value, self.strike, fwd_price, sigma, t, r)[0])
+
+    def baw_value(self, market_day: Day, fwd_price: float, sigma: float, r: float) -> float:
+        # Falls back to the PDE where the approximation doesn't apply or fails its checks
+        t = self.expiry.time_since(market_day)
+        values, converged = barone_adesi_whaley_values(self.right.value, self.strike, fwd_price, sigma, t, r)
+        if not converged:
+            return self.cn_value(market_day, fwd_price, sigma, r)
+        return float(values)
+
+    def value(
+            self,
+            market_day: Day,
+            fwd_price: float,
+            sigma: float,
+            r: float,
+            american_method: AmericanMethod = None) -> float:
         if self.ex_style == ExerciseStyle.EUROPEAN:
             return self.european_value(market_day, fwd_price, sigma, r)
-        else:
+        american_method = american_method or default_american_method()
+        if american_method is AmericanMethod.CRANK_NICHOLSON:
             return self.cn_value(market_day, fwd_price, sigma, r)
+        if american_method is AmericanMethod.BARONE_ADESI_WHALEY:
+            return self.baw_value(market_day, fwd_price, sigma, r)
+        raise Exception(f"Unexpected American method {american_method}")
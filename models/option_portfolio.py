@@ -0,0 +1,77 @@
+import numpy as np
+
+from models.day import Day, DayArray
+from models.option import AmericanMethod, ExerciseStyle, right_codes
+from models.option_calcs import barone_adesi_whaley_values, black_scholes_values, crank_nicholson_values, \
+    check_right_codes
+from models.option_instrument import default_american_method
+
+
+class OptionPortfolio:
+    # A book of options held as columns. Values come back as arrays aligned with the columns.
+    def __init__(self, strikes, rights, expiries, american):
+        self.strikes = np.asarray(strikes, float)
+        self.rights = np.asarray(rights, int)
+        self.expiries = DayArray(expiries)
+        self.american = np.asarray(american, bool)
+
+        n_options = len(self.strikes)
+        for name in ("rights", "expiries", "american"):
+            if len(getattr(self, name)) != n_options:
+                raise Exception(f"Portfolio has {n_options} strikes but {len(getattr(self, name))} {name}")
+        check_right_codes(self.rights)
+
+    @classmethod
+    def from_instruments(cls, instruments):
+        return cls(
+            [option.strike for option in instruments],
+            right_codes([option.right for option in instruments]),
+            [option.expiry for option in instruments],
+            [option.ex_style == ExerciseStyle.AMERICAN for option in instruments]
+        )
+
+    def __len__(self):
+        return len(self.strikes)
+
+    def times_to_expiry(self, market_day: Day):
+        return self.expiries.time_since(market_day)
+
+    def values(self, market_day: Day, fwd_prices, sigmas, r, american_method: AmericanMethod = None):
+        # fwd_prices, sigmas and r are per option or shared. Europeans take one vectorized
+        # Black-Scholes call. Americans go to Barone-Adesi-Whaley in one call if selected, and
+        # the rest to Crank-Nicholson, one strip solve per distinct (expiry, sigma, r).
+        n_options = len(self)
+        ts = self.times_to_expiry(market_day)
+        fwd_prices, sigmas, rs = (
+            np.broadcast_to(np.asarray(x, float), (n_options,)) for x in (fwd_prices, sigmas, r)
+        )
+        values = np.zeros((n_options,), float)
+
+        european = ~self.american
+        values[european] = np.exp(-rs[european] * ts[european]) * black_scholes_values(
+            self.rights[european], self.strikes[european], fwd_prices[european], sigmas[european], ts[european]
+        )
+
+        on_grid = self.american.copy()
+        american_method = american_method or default_american_method()
+        if american_method is AmericanMethod.BARONE_ADESI_WHALEY:
+            baw_values, converged = barone_adesi_whaley_values(
+                self.rights[on_grid], self.strikes[on_grid], fwd_prices[on_grid], sigmas[on_grid], ts[on_grid],
+                rs[on_grid]
+            )
+            i_american = np.flatnonzero(on_grid)
+            values[i_american[converged]] = baw_values[converged]
+            on_grid[i_american[converged]] = False
+        elif american_method is not AmericanMethod.CRANK_NICHOLSON:
+            raise Exception(f"Unexpected American method {american_method}")
+
+        i_grid = np.flatnonzero(on_grid)
+        keys, groups = np.unique(np.stack([ts[i_grid], sigmas[i_grid], rs[i_grid]]), axis=1, return_inverse=True)
+        for i_group, (t, sigma, group_r) in enumerate(np.transpose(keys)):
+            i_options = i_grid[np.reshape(groups, (-1,)) == i_group]
+            values[i_options] = crank_nicholson_values(
+                self.rights[i_options], ExerciseStyle.AMERICAN, self.strikes[i_options], fwd_prices[i_options],
+                sigma, group_r, t, 100, 100, 4
+            )
+
+        return values
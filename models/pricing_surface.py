@@ -0,0 +1,172 @@
+import numpy as np
+
+from scipy.interpolate import CubicSpline
+
+from models.option import ExerciseStyle, OptionRight
+from models.option_calcs import intrinsic_values, check_right_codes, crank_nicholson_grid_values, crank_nicholson_value
+
+_RIGHT_CODES = np.array([right.value for right in OptionRight])
+
+
+class AmericanPricingSurface:
+    # American futures option values, scaled by strike, depend only on log(F / K), the total vol
+    # w = sigma * sqrt(t) and r * t. The surface tabulates the time value over intrinsic divided
+    # by w against standardized moneyness y = log(F / K) / w, w and r * t, which stays smooth as
+    # w goes to zero where the value itself develops the payoff kink. Lookups interpolate linearly
+    # along each axis; beyond the y range the time value is taken as zero, below the first w node
+    # the first row is used.
+    #
+    # cell_bounds holds, for every grid cell, the trilinear interpolation error estimate
+    # sum_a h_a^2 / 8 * max |d^2 g / da^2| with the second derivatives taken from divided differences
+    # of the table at the cell's corners. error_bounds turns it into price units, K * w times the
+    # cell bound. Neither includes the discretization error of the Crank-Nicholson solves behind the table.
+    def __init__(self, standardized_moneyness, total_vols, rate_times, time_values):
+        self.standardized_moneyness = np.asarray(standardized_moneyness, float)
+        self.total_vols = np.asarray(total_vols, float)
+        self.rate_times = np.asarray(rate_times, float)
+        self.time_values = np.asarray(time_values, float)
+
+        self.axes = (self.total_vols, self.rate_times, self.standardized_moneyness)
+        shape = (len(_RIGHT_CODES),) + tuple(len(axis) for axis in self.axes)
+        if self.time_values.shape != shape:
+            raise Exception(f"Surface time values have shape {self.time_values.shape}, expected {shape}")
+        if min(shape[1:]) < 3:
+            raise Exception(f"Every surface axis needs at least three points, got {shape[1:]}")
+        if self.total_vols[0] <= 0.0:
+            raise Exception(f"Total vols must be positive, got {self.total_vols[0]}")
+
+        self.cell_bounds = self._cell_bounds()
+        # Bound on the time value dropped beyond the standardized moneyness range
+        self.tail_bound = float(np.max(np.abs(self.time_values[..., [0, -1]])))
+
+    @classmethod
+    def build(
+            cls,
+            standardized_moneyness=np.linspace(-5.0, 5.0, 201),
+            total_vols=np.linspace(0.01, 1.0, 45),
+            rate_times=np.linspace(0.0, 0.3, 31),
+            n: int = 400, n_times: int = 400, std_devs: float = 7.0):
+        # One solve per (total vol, rate time) node values all three rights for every moneyness.
+        # With t = 1, sigma is the total vol and r the rate time.
+        standardized_moneyness = np.asarray(standardized_moneyness, float)
+        if np.max(np.abs(standardized_moneyness)) >= std_devs:
+            raise Exception(f"Standardized moneyness has to stay inside the {std_devs} std dev PDE grid")
+
+        time_values = np.zeros(
+            (len(_RIGHT_CODES), len(total_vols), len(rate_times), len(standardized_moneyness)), float
+        )
+        for i_vol, total_vol in enumerate(total_vols):
+            relative_fwds = np.exp(standardized_moneyness * total_vol)
+            intrinsics = intrinsic_values(_RIGHT_CODES[:, np.newaxis], 1.0, relative_fwds)
+            for i_rate, rate_time in enumerate(rate_times):
+                relative_prices, columns = crank_nicholson_grid_values(
+                    _RIGHT_CODES, ExerciseStyle.AMERICAN, np.ones(len(_RIGHT_CODES)), total_vol, rate_time, 1.0,
+                    n, n_times, std_devs
+                )
+                values = np.transpose(CubicSpline(relative_prices, columns)(relative_fwds))
+                time_values[:, i_vol, i_rate] = (values - intrinsics) / total_vol
+
+        return cls(standardized_moneyness, total_vols, rate_times, time_values)
+
+    def save(self, path):
+        np.savez(
+            path, standardized_moneyness=self.standardized_moneyness, total_vols=self.total_vols,
+            rate_times=self.rate_times, time_values=self.time_values
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["standardized_moneyness"], data["total_vols"], data["rate_times"], data["time_values"])
+
+    def _cell_bounds(self):
+        bounds = np.zeros((len(_RIGHT_CODES),) + tuple(len(axis) - 1 for axis in self.axes), float)
+        for i_axis, axis in enumerate(self.axes, start=1):
+            time_values = np.moveaxis(self.time_values, i_axis, -1)
+            h_left = np.diff(axis)[:-1]
+            h_right = np.diff(axis)[1:]
+            # |g''| from the gap between each interior node and the chord through its neighbours
+            chord = (h_right * time_values[..., :-2] + h_left * time_values[..., 2:]) / (h_left + h_right)
+            curvature = 2.0 * np.abs(time_values[..., 1:-1] - chord) / (h_left * h_right)
+            curvature = np.concatenate([curvature[..., :1], curvature, curvature[..., -1:]], axis=-1)
+            curvature = np.moveaxis(curvature, -1, i_axis)
+
+            # Largest curvature over the eight corners of each cell
+            corners = curvature
+            for i_corner_axis in range(1, 4):
+                corners = np.maximum(
+                    np.take(corners, range(0, corners.shape[i_corner_axis] - 1), axis=i_corner_axis),
+                    np.take(corners, range(1, corners.shape[i_corner_axis]), axis=i_corner_axis)
+                )
+
+            widths = np.square(np.diff(axis)) / 8.0
+            bounds += corners * np.reshape(widths, [-1 if i == i_axis else 1 for i in range(4)])
+        return bounds
+
+    def _locate(self, total_vols, rate_times, standardized_moneyness):
+        # Cell indices and fractional positions along each axis. Total vols below the first node and
+        # moneyness off either end are clamped; only w above the last node and r * t off the axis
+        # leave the surface.
+        cells = []
+        for axis, coordinates in zip(self.axes, (total_vols, rate_times, standardized_moneyness)):
+            coordinates = np.clip(coordinates, axis[0], axis[-1])
+            i_cell = np.clip(np.searchsorted(axis, coordinates, side="right") - 1, 0, len(axis) - 2)
+            fraction = (coordinates - axis[i_cell]) / (axis[i_cell + 1] - axis[i_cell])
+            cells.append((i_cell, fraction))
+
+        on_surface = (total_vols <= self.total_vols[-1]) & (rate_times >= self.rate_times[0]) & (
+                rate_times <= self.rate_times[-1])
+        in_range = (standardized_moneyness >= self.standardized_moneyness[0]) & (
+                standardized_moneyness <= self.standardized_moneyness[-1])
+        return cells, on_surface, in_range
+
+    def _coordinates(self, rights, strikes, fwd_prices, sigmas, ts, rs):
+        rights, strikes, fwd_prices, sigmas, ts, rs = np.broadcast_arrays(
+            np.atleast_1d(rights), np.asarray(strikes, float), np.asarray(fwd_prices, float),
+            np.asarray(sigmas, float), np.asarray(ts, float), np.asarray(rs, float)
+        )
+        check_right_codes(rights)
+        total_vols = sigmas * np.sqrt(np.maximum(ts, 0.0))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            standardized_moneyness = np.log(fwd_prices / strikes) / total_vols
+        return rights, strikes, fwd_prices, sigmas, ts, rs, total_vols, rs * ts, standardized_moneyness
+
+    def error_bounds(self, rights, strikes, fwd_prices, sigmas, ts, rs):
+        # Error estimate in price units, NaN where lookups fall back to Crank-Nicholson
+        rights, strikes, _, _, _, _, total_vols, rate_times, standardized_moneyness = self._coordinates(
+            rights, strikes, fwd_prices, sigmas, ts, rs
+        )
+        ((i_vol, _), (i_rate, _), (i_y, _)), on_surface, in_range = self._locate(
+            total_vols, rate_times, standardized_moneyness
+        )
+        bounds = np.where(in_range, self.cell_bounds[rights - 1, i_vol, i_rate, i_y], self.tail_bound)
+        return np.where(on_surface, strikes * total_vols * bounds, np.nan)
+
+    def option_values(
+            self, rights, strikes, fwd_prices, sigmas, ts, rs,
+            n: int = 100, n_times: int = 100, std_devs: float = 4.0):
+        # Discounted American values. Options off the surface are valued one by one with
+        # crank_nicholson_value using n, n_times and std_devs.
+        rights, strikes, fwd_prices, sigmas, ts, rs, total_vols, rate_times, standardized_moneyness = \
+            self._coordinates(rights, strikes, fwd_prices, sigmas, ts, rs)
+        cells, on_surface, in_range = self._locate(total_vols, rate_times, standardized_moneyness)
+        ((i_vol, f_vol), (i_rate, f_rate), (i_y, f_y)) = cells
+
+        i_right = rights - 1
+        time_values = np.zeros(rights.shape, float)
+        for d_vol, w_vol in ((0, 1.0 - f_vol), (1, f_vol)):
+            for d_rate, w_rate in ((0, 1.0 - f_rate), (1, f_rate)):
+                for d_y, w_y in ((0, 1.0 - f_y), (1, f_y)):
+                    corner = self.time_values[i_right, i_vol + d_vol, i_rate + d_rate, i_y + d_y]
+                    time_values += w_vol * w_rate * w_y * corner
+
+        values = intrinsic_values(rights, strikes, fwd_prices) + np.where(
+            in_range, strikes * total_vols * time_values, 0.0
+        )
+
+        for i in zip(*np.nonzero(~on_surface)):
+            values[i] = crank_nicholson_value(
+                OptionRight(int(rights[i])), ExerciseStyle.AMERICAN, strikes[i], fwd_prices[i], sigmas[i], rs[i],
+                ts[i], n, n_times, std_devs
+            )
+        return values
@@ -2,66 +2,172 @@ import os
 import re
 import numpy as np
 
+from models import instrumentation
+
+_BITS = 52
+_RESOURCES_DIR = f"{os.path.dirname(os.path.realpath(__file__))}/resources"
+_JOE_KUO_FILE = "new-joe-kuo-7.21201"
+
+_direction_table = None
+_direction_cache = {}
+
+
+def build_direction_table():
+    p = re.compile(" +")
+    with open(f"{_RESOURCES_DIR}/{_JOE_KUO_FILE}", "r") as f:
+        rows = [list(map(int, p.split(line.strip()))) for line in list(f)[1:]]
+
+    table = np.zeros((len(rows) + 1, _BITS + 1), np.uint64)
+    table[0, 1:] = [1 << (_BITS - i) for i in range(1, _BITS + 1)]
+
+    # Dimensions sharing a degree s share the recurrence, so build each degree in one pass
+    degrees = np.array([row[1] for row in rows])
+    for s in np.unique(degrees):
+        dims = np.flatnonzero(degrees == s)
+        a = np.array([rows[i][2] for i in dims], np.uint64)
+        m = np.array([rows[i][3:] for i in dims], np.uint64)
+        direction = np.zeros((len(dims), _BITS + 1), np.uint64)
+
+        for i in range(1, s + 1):
+            direction[:, i] = m[:, i - 1] << np.uint64(_BITS - i)
+
+        for i in range(s + 1, _BITS + 1):
+            direction[:, i] = direction[:, i - s] ^ (direction[:, i - s] >> np.uint64(s))
+            for k in range(1, s):
+                bit = (a >> np.uint64(s - 1 - k)) & np.uint64(1)
+                direction[:, i] ^= bit * direction[:, i - k]
+
+        table[dims + 1] = direction
+
+    return table
+
+
+def _direction_table_path():
+    cache_dir = os.environ.get("PYMODELS_CACHE_DIR", _RESOURCES_DIR)
+    return f"{cache_dir}/{_JOE_KUO_FILE}.b{_BITS}.npy"
+
+
+def direction_table():
+    # Memory-maps the table cached on disk, building and caching it on first use. If the cache
+    # directory is missing or read-only the table is built in memory instead, once per process.
+    global _direction_table
+    if _direction_table is None:
+        path = _direction_table_path()
+        if not os.path.exists(path):
+            table = build_direction_table()
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, "wb") as f:
+                    np.save(f, table)
+                os.replace(tmp_path, path)
+            except OSError:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                _direction_table = table
+                return _direction_table
+        _direction_table = np.load(path, mmap_mode="r")
+    return _direction_table
+
+
+def direction_numbers(n_variables):
+    if n_variables not in _direction_cache:
+        table = direction_table()
+        if n_variables > len(table):
+            raise Exception(f"At most {len(table)} Sobol dimensions are supported, got {n_variables}")
+        _direction_cache[n_variables] = table[:n_variables]
+    return _direction_cache[n_variables]
+
+
+def _parity(x):
+    for shift in (32, 16, 8, 4, 2, 1):
+        x = x ^ (x >> np.uint64(shift))
+    return x & np.uint64(1)
+
+
+def scramble_directions(directions, rng):
+    # Random lower-triangular linear matrix scramble (Matousek), applied to every
+    # direction number of a dimension at once. Output bit r, counted from the most
+    # significant, mixes input bits 0..r.
+    n_variables = len(directions)
+    random_bits = rng.integers(0, 1 << _BITS, size=(_BITS, n_variables), dtype=np.uint64)
+    scrambled = np.zeros_like(directions)
+    for r in range(_BITS):
+        diagonal = np.uint64(1 << (_BITS - 1 - r))
+        above_diagonal = np.uint64(((1 << _BITS) - 1) ^ ((1 << (_BITS - r)) - 1))
+        row = (random_bits[r] & above_diagonal) | diagonal
+        scrambled |= _parity(directions & row[:, np.newaxis]) * diagonal
+    return scrambled
+
 
 class SobolGenerator:
-    def __init__(self, n_variables):
+    def __init__(self, n_variables, seed=None):
 
         self.n_variables = n_variables
-        self.bits = 52
+        self.bits = _BITS
         self.scale = 1.0 / np.power(2.0, self.bits)
-
-        p = re.compile(" +")
-
-        def build_direction(line):
-            arr = list(map(int, p.split(line.strip())))
-            a = arr[2]
-            m = arr[3:]
-            m.insert(0, 0)
-            s = len(m) - 1
-            direction = np.zeros((self.bits + 1,), int)
-
-            for i in range(1, s + 1):
-                direction[i] = (m[i] << (self.bits - i))
-
-            for i in range(s + 1, self.bits + 1):
-                direction[i] = direction[i - s] ^ (direction[i - s] >> s)
-                for k in range(1, s):
-                    x = a >> (s - 1 - k)
-                    y = x & 1
-                    z = y * direction[i - k]
-
-                    direction[i] = direction[i] ^ z  # (((a >> (s - 1 - k)) & 1) * direction[i - k])
-
-            return direction
-
-        self.directions = np.zeros((n_variables, self.bits + 1), int)
-        with open(f"{os.path.dirname(os.path.realpath(__file__))}/resources/new-joe-kuo-7.21201", "r") as f:
-            head = [next(f) for x in range(n_variables)]
-            for i, line in enumerate(head[1:]):
-                self.directions[i + 1] = build_direction(line)
-
-        one_direction = [1 << (self.bits - i) for i in range(1, self.bits + 1)]
-        one_direction.insert(0, 0)
-
-        self.directions[0] = np.array(one_direction)
-
-    def generate(self, n_paths):
-
-        arr = np.zeros((n_paths, self.n_variables), float)
-        x = np.zeros((self.n_variables,), int)
-        count = 1
-        var_range = range(self.n_variables)
-        for i_path in range(n_paths):
-            c = 1
-            value = count - 1
-            while (value & 1) == 1:
-                value >>= 1
-                c += 1
-
-            for i_var in var_range:
-                x[i_var] ^= self.directions[i_var, c]
-                arr[i_path, i_var] = x[i_var] * self.scale
-
-            count += 1
-
-        return np.transpose(arr)
+        self.directions = direction_numbers(n_variables)
+        self.shift = np.zeros((n_variables,), np.uint64)
+        self.offset = 0.0
+
+        # A seed turns on randomized QMC: linear matrix scrambling plus a random digital shift.
+        # Both act on the direction numbers and the starting state, so generation cost is unchanged.
+        if seed is not None:
+            rng = np.random.default_rng(seed)
+            self.directions = scramble_directions(self.directions, rng)
+            self.shift = rng.integers(0, 1 << _BITS, size=(n_variables,), dtype=np.uint64)
+            self.offset = 0.5 * self.scale
+
+    def state_at(self, index):
+        # Sobol point number index is the XOR of the direction numbers picked out by its Gray code
+        gray = index ^ (index >> 1)
+        x = self.shift.copy()
+        c = 1
+        while gray:
+            if gray & 1:
+                x ^= self.directions[:, c]
+            gray >>= 1
+            c += 1
+        return x
+
+    def generate(self, n_paths, out=None, block_size=1024, start=0):
+        with instrumentation.timer("sobol.generate"):
+            out = self._generate(n_paths, out, block_size, start)
+        instrumentation.count("sobol.points", n_paths)
+        return out
+
+    def _generate(self, n_paths, out, block_size, start):
+
+        if out is None:
+            out = np.zeros((self.n_variables, n_paths), float)
+        elif out.shape != (self.n_variables, n_paths):
+            raise Exception(f"Output has shape {out.shape}, expected {(self.n_variables, n_paths)}")
+
+        x = self.state_at(start)
+        block = np.zeros((self.n_variables, min(block_size, n_paths)), np.uint64)
+
+        for i_block_start in range(0, n_paths, block_size):
+            n_block = min(block_size, n_paths - i_block_start)
+            points = block[:, :n_block]
+
+            # Path i flips the direction number indexed by the lowest set bit of i + 1
+            i_first = start + i_block_start + 1
+            counts = np.arange(i_first, i_first + n_block, dtype=np.uint64)
+            c = np.frexp(counts & (~counts + np.uint64(1)))[1]
+
+            np.take(self.directions, c, axis=1, out=points)
+            points[:, 0] ^= x
+            np.bitwise_xor.accumulate(points, axis=1, out=points)
+            x[:] = points[:, n_block - 1]
+
+            np.multiply(points, self.scale, out=out[:, i_block_start:i_block_start + n_block])
+
+        if self.offset:
+            out += self.offset
+
+        return out
+
+
+def sobol_shards(n_paths, n_shards, start=0):
+    n_shards = max(1, min(n_shards, n_paths))
+    bounds = [start + (n_paths * i) // n_shards for i in range(n_shards + 1)]
+    return [(bounds[i], bounds[i + 1] - bounds[i]) for i in range(n_shards)]
@@ -1,6 +1,12 @@
+import tempfile
+
 import numpy as np
 
-from models.brownian_generator import generate_brownians
+from models.brownian_generator import BrownianLayout, DimensionOrdering, Factorization, brownians_at, \
+    brownians_shape, generate_brownians, generate_brownians_in_chunks
+from models import instrumentation
+from models.monte_carlo import MonteCarloEstimate, replicate_seeds, replicate_estimate, sample_estimate, \
+    streaming_estimate
 from numpy import exp, sqrt
 
 
@@ -10,24 +16,30 @@ class CombinedPriceProcess:
                  times: np.ndarray,
                  sigma: float,
                  tilt_vol: float,
+                 correlation: float = 0.0,
                  ):
         self.fwd_prices = fwd_prices
         self.times = times
         self.sigma = sigma
         self.tilt_vol = tilt_vol
+        self.correlation = correlation
+
+    def correlation_matrix(self):
+        return np.array([[1.0, self.correlation], [self.correlation, 1.0]])
 
-    def generate(self, brownians, i_time):
+    def generate(self, brownians, i_time, layout: BrownianLayout = BrownianLayout.PATH_MAJOR):
         t = self.times[i_time]
-        z1 = brownians[:, 0, i_time]
-        z2 = brownians[:, 1, i_time]
+        z1, z2 = brownians_at(brownians, i_time, layout)
         p1 = self.fwd_prices[i_time] * exp(z1 * self.sigma - 0.5 * self.sigma * self.sigma * t)
         tilt = z2 * self.tilt_vol
         return p1 + tilt
 
 
-def _design_matrix(brownians, i_time):
-    z1 = brownians[:, 0, i_time]
-    z2 = brownians[:, 1, i_time]
+_VOLUME_CHANGES = np.array([-1, 0, 1])
+
+
+def _design_matrix(brownians, i_time, layout: BrownianLayout = BrownianLayout.PATH_MAJOR):
+    z1, z2 = brownians_at(brownians, i_time, layout)
     n_paths = len(z1)
     m = np.zeros((n_paths, 6))
     m[:, 0] = 1.0
@@ -59,41 +71,81 @@ def state_ranges(initial_volume: int, max_volume: int, n_times: int):
     return min_levels, max_levels
 
 
-def svd_solve(design_matrix, option_values):
+class StoragePolicy:
+    # Exercise policy from a backward pass: coefficients[i_time, eod_state] are the _design_matrix
+    # regression coefficients of the continuation value of ending date i_time in eod_state,
+    # averaged over the two halves' fits. States outside a date's EOD range are left at zero.
+    def __init__(self, initial_volume: int, max_volume: int, coefficients):
+        self.initial_volume = int(initial_volume)
+        self.max_volume = int(max_volume)
+        self.coefficients = np.asarray(coefficients, float)
+        if self.coefficients.ndim != 3 or self.coefficients.shape[1:] != (max_volume + 1, 6):
+            raise Exception(
+                f"Policy coefficients have shape {self.coefficients.shape}, expected (n_times, {max_volume + 1}, 6)"
+            )
+
+    @classmethod
+    def empty(cls, initial_volume: int, max_volume: int, n_times: int):
+        return cls(initial_volume, max_volume, np.zeros((n_times, max_volume + 1, 6), float))
+
+    @property
+    def n_times(self):
+        return len(self.coefficients)
+
+    def save(self, path):
+        np.savez(
+            path, initial_volume=self.initial_volume, max_volume=self.max_volume, coefficients=self.coefficients
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(int(data["initial_volume"]), int(data["max_volume"]), data["coefficients"])
+
+
+def svd_solve(design_matrix, option_values, rcond: float = None):
+    # Least squares through one SVD for any number of right hand side columns. Singular values
+    # below rcond times the largest are dropped, as in np.linalg.lstsq, so rank deficient
+    # designs (e.g. no volatility) still fit.
     u, s, vt = np.linalg.svd(design_matrix, full_matrices=False)
-    v = np.transpose(vt)
-    sigma_inv = np.diag(1/s)
-    print(f"sigma {s}")
-    print(f"u {u}")
-    print(f"opt values {option_values}")
-    pseudo_inverse = np.matmul(np.matmul(v, sigma_inv), np.transpose(u))
-    x = np.matmul(pseudo_inverse, option_values)
-    return x
-
-
-def cond_exp(design_matrix, option_values):
+    if rcond is None:
+        rcond = np.finfo(float).eps * max(design_matrix.shape)
+    kept = s > rcond * s[0]
+    projections = np.matmul(np.transpose(u[:, kept]), option_values)
+    projections /= np.reshape(s[kept], (-1,) + (1,) * (np.ndim(option_values) - 1))
+    return np.matmul(np.transpose(vt[kept]), projections)
+
+
+def cond_exp(design_matrix, option_values, coefficients=None):
+    # Each half's regression predicts the other half. option_values has paths on its last axis,
+    # one row per state, and every state is regressed against the same factorization.
+    # coefficients, if given, receives the mean of the two halves' fits, one row per state.
     n_paths = len(design_matrix)
     dm1 = design_matrix[0:n_paths // 2]
-    ov1 = option_values[0:n_paths // 2]
     dm2 = design_matrix[n_paths // 2:]
-    ov2 = option_values[n_paths // 2:]
-    sol1 = svd_solve(dm1, ov1)
-    sol2 = svd_solve(dm2, ov2)
-    solution = np.zeros((n_paths,), float)
-    foo = np.matmul(dm1, sol2)
-    solution[0:n_paths // 2] = foo
-    np.matmul(dm2, sol1, solution[n_paths // 2:])
+    values = np.transpose(option_values)
+    sol1 = svd_solve(dm1, values[0:n_paths // 2])
+    sol2 = svd_solve(dm2, values[n_paths // 2:])
+    solution = np.zeros(values.shape, float)
+    np.matmul(dm1, sol2, out=solution[0:n_paths // 2])
+    np.matmul(dm2, sol1, out=solution[n_paths // 2:])
 
-    return solution
+    if coefficients is not None:
+        coefficients[...] = np.transpose(0.5 * (sol1 + sol2))
+    return np.transpose(solution)
 
 
-def value_storage_unit(
+def _storage_path_values(
         initial_volume: int,
         max_volume: int,
         process: CombinedPriceProcess,
-        n_paths: int) -> float:
+        brownians,
+        layout: BrownianLayout = BrownianLayout.PATH_MAJOR,
+        policy=None):
+    # Per-path values from the backward induction. A StoragePolicy passed in gets the
+    # regression coefficients of every exercise date.
+    n_paths = brownians_at(brownians, 0, layout).shape[1]
     n_times = len(process.times)
-    brownians = generate_brownians(n_paths, n_variables=2, times=process.times)
 
     min_levels, max_levels = state_ranges(initial_volume, max_volume, n_times)
     n_states = max_volume + 1
@@ -101,53 +153,194 @@ def value_storage_unit(
     state_values_sod = np.zeros((n_states, n_paths), float)
 
     for i_exercise in range(n_times - 1, -1, -1):
-        sod_range = range(min_levels[i_exercise], max_levels[i_exercise] + 1)
-
         full_eod_range = range(min_levels[i_exercise + 1], max_levels[i_exercise + 1] + 1)
 
-        dm = _design_matrix(brownians, i_exercise)
-        cond_exps = np.zeros((len(full_eod_range), n_paths), float)
-        min_eod_state = full_eod_range[0]
-        for i_eod in full_eod_range:
-            post_ex_values = state_values_eod[i_eod]
-            cond_exps[i_eod - min_eod_state] = cond_exp(dm, post_ex_values)
-        print(f"ex {i_exercise}")
-        print(cond_exps)
+        with instrumentation.timer("storage.regression"):
+            dm = _design_matrix(brownians, i_exercise, layout)
+            min_eod_state = full_eod_range[0]
+            eod_states = slice(min_eod_state, full_eod_range[-1] + 1)
+            coefficients = None if policy is None else policy.coefficients[i_exercise, eod_states]
+            cond_exps = cond_exp(dm, state_values_eod[eod_states], coefficients)
 
-        prices = process.generate(brownians, i_exercise)
+        with instrumentation.timer("storage.decision"):
+            _exercise_decision(
+                process.generate(brownians, i_exercise, layout), cond_exps, full_eod_range,
+                min_levels[i_exercise], max_levels[i_exercise], state_values_eod, state_values_sod
+            )
 
-        for i_sod in sod_range:
-            i_eod_min = max(i_sod - 1, min_levels[i_exercise + 1])
-            i_eod_max = min(i_sod + 1, max_levels[i_exercise + 1])
+        tmp = state_values_eod
+        state_values_eod = state_values_sod
+        state_values_sod = tmp
 
-            def transfer_value(price, i_eod):
-                d_volume = i_eod - i_sod
-                return price * -d_volume
+    instrumentation.count("storage.exercise_dates", n_times)
+    instrumentation.count("storage.paths", n_paths)
+    return state_values_eod[initial_volume]
 
-            def transition_value(price, i_eod, i_path):
-                return transfer_value(price, i_eod) + cond_exps[i_eod - min_eod_state, i_path]
 
-            for i_path in range(n_paths):
-                price = prices[i_path]
-                i_best_eod = i_eod_min
-                best_transition_value = transition_value(price, i_eod_min, i_path)
+def _exercise_decision(prices, cond_exps, full_eod_range, min_sod, max_sod, state_values_eod, state_values_sod):
+    # Candidate EOD states are SOD - 1, SOD and SOD + 1, in that order, so argmax picks the
+    # lowest EOD state among equally good ones. Candidates outside the EOD range never win.
+    sods = np.arange(min_sod, max_sod + 1)
+    eods = sods + _VOLUME_CHANGES[:, np.newaxis]
+    feasible = (eods >= full_eod_range[0]) & (eods <= full_eod_range[-1])
+    eods = np.clip(eods, full_eod_range[0], full_eod_range[-1])
 
-                for i_eod in range(i_eod_min + 1, i_eod_max + 1):
-                    next_value = transition_value(price, i_eod, i_path)
-                    if next_value > best_transition_value:
-                        best_transition_value = next_value
-                        i_best_eod = i_eod
+    transfer_values = -_VOLUME_CHANGES[:, np.newaxis] * prices
+    transition_values = cond_exps[eods - full_eod_range[0]] + transfer_values[:, np.newaxis, :]
+    transition_values[~feasible] = -np.inf
+    i_best = np.argmax(transition_values, axis=0)
 
-                state_values_sod[i_sod, i_path] = transfer_value(price, i_best_eod) + state_values_eod[i_best_eod, i_path]
+    best_changes = _VOLUME_CHANGES[i_best]
+    state_values_sod[sods] = -best_changes * prices + np.take_along_axis(
+        state_values_eod, sods[:, np.newaxis] + best_changes, axis=0
+    )
 
-                if i_path == 17:
-                    print(f"sod = {i_sod}, best eod {i_best_eod}, value {state_values_sod[i_sod, i_path]}")
 
-        print("SOD")
-        print(state_values_sod)
-        tmp = state_values_eod
-        state_values_eod = state_values_sod
-        state_values_sod = tmp
+def _policy_path_values(
+        policy: StoragePolicy,
+        process: CombinedPriceProcess,
+        brownians,
+        layout: BrownianLayout = BrownianLayout.PATH_MAJOR):
+    # Per-path cash flows from running the policy forward: on each date every path moves to the
+    # feasible EOD state with the best transfer value plus regressed continuation value, ties going
+    # to the lowest state as in the backward pass.
+    n_paths = brownians_at(brownians, 0, layout).shape[1]
+    n_times = len(process.times)
+    if policy.n_times != n_times:
+        raise Exception(f"Policy has {policy.n_times} exercise dates, process has {n_times}")
+
+    min_levels, max_levels = state_ranges(policy.initial_volume, policy.max_volume, n_times)
+    volumes = np.full((n_paths,), policy.initial_volume, int)
+    path_values = np.zeros((n_paths,), float)
 
+    for i_exercise in range(n_times):
+        with instrumentation.timer("storage.forward"):
+            prices = process.generate(brownians, i_exercise, layout)
+            dm = _design_matrix(brownians, i_exercise, layout)
+            continuations = np.matmul(policy.coefficients[i_exercise], np.transpose(dm))
 
-    return np.mean(state_values_eod[initial_volume])
+            eods = volumes + _VOLUME_CHANGES[:, np.newaxis]
+            min_eod, max_eod = min_levels[i_exercise + 1], max_levels[i_exercise + 1]
+            feasible = (eods >= min_eod) & (eods <= max_eod)
+            eods = np.clip(eods, min_eod, max_eod)
+
+            transition_values = np.take_along_axis(continuations, eods, axis=0) - \
+                _VOLUME_CHANGES[:, np.newaxis] * prices
+            transition_values[~feasible] = -np.inf
+            best_changes = _VOLUME_CHANGES[np.argmax(transition_values, axis=0)]
+
+            path_values -= best_changes * prices
+            volumes += best_changes
+
+    instrumentation.count("storage.paths", n_paths)
+    return path_values
+
+
+def value_storage_unit(
+        initial_volume: int,
+        max_volume: int,
+        process: CombinedPriceProcess,
+        n_paths: int,
+        n_processes: int = 1,
+        dtype=float,
+        factorization: Factorization = Factorization.CHOLESKY,
+        ordering: DimensionOrdering = DimensionOrdering.INTERLEAVED,
+        scratch_dir: str = None,
+        chunk_size: int = 4096,
+        return_policy: bool = False):
+    # With a scratch_dir the brownians are spilled to a memory-mapped temporary file there,
+    # generated chunk_size paths at a time. The backward pass then reads one time slice per
+    # exercise date, so resident memory follows the paths per slice rather than the horizon.
+    # With return_policy the result is (value, StoragePolicy) for forward_value_storage_unit.
+    layout = BrownianLayout.TIME_MAJOR
+    policy = StoragePolicy.empty(initial_volume, max_volume, len(process.times)) if return_policy else None
+    if scratch_dir is None:
+        brownians = generate_brownians(
+            n_paths, n_variables=2, times=process.times, n_processes=n_processes, layout=layout, dtype=dtype,
+            correlation=process.correlation_matrix(), factorization=factorization, ordering=ordering
+        )
+        value = np.mean(_storage_path_values(initial_volume, max_volume, process, brownians, layout, policy))
+        return (value, policy) if return_policy else value
+
+    with tempfile.TemporaryFile(dir=scratch_dir) as scratch:
+        brownians = np.memmap(
+            scratch, dtype=dtype, mode="w+", shape=brownians_shape(n_paths, 2, len(process.times), layout)
+        )
+        generate_brownians_in_chunks(
+            brownians, n_variables=2, times=process.times, chunk_size=chunk_size, n_processes=n_processes,
+            layout=layout, correlation=process.correlation_matrix(), factorization=factorization, ordering=ordering
+        )
+        value = np.mean(_storage_path_values(initial_volume, max_volume, process, brownians, layout, policy))
+        del brownians
+    return (value, policy) if return_policy else value
+
+
+def forward_value_storage_unit(
+        policy: StoragePolicy,
+        process: CombinedPriceProcess,
+        n_paths: int,
+        start: int = 0,
+        seed=None,
+        n_processes: int = 1,
+        dtype=float,
+        factorization: Factorization = Factorization.CHOLESKY,
+        ordering: DimensionOrdering = DimensionOrdering.INTERLEAVED) -> MonteCarloEstimate:
+    # One forward pass under a stored policy, e.g. against a process with shifted forward prices.
+    # On paths the policy was not fitted to (a later start or another seed) the policy is only
+    # suboptimal, so the value is a low biased estimate of the storage value.
+    layout = BrownianLayout.TIME_MAJOR
+    brownians = generate_brownians(
+        n_paths, n_variables=2, times=process.times, start=start, n_processes=n_processes, seed=seed,
+        layout=layout, dtype=dtype,
+        correlation=process.correlation_matrix(), factorization=factorization, ordering=ordering
+    )
+    return sample_estimate(_policy_path_values(policy, process, brownians, layout))
+
+
+def randomized_value_storage_unit(
+        initial_volume: int,
+        max_volume: int,
+        process: CombinedPriceProcess,
+        n_paths: int,
+        n_replicates: int = 8,
+        seed=None,
+        n_processes: int = 1,
+        dtype=float,
+        factorization: Factorization = Factorization.CHOLESKY,
+        ordering: DimensionOrdering = DimensionOrdering.INTERLEAVED) -> MonteCarloEstimate:
+    layout = BrownianLayout.TIME_MAJOR
+    values = []
+    for replicate_seed in replicate_seeds(seed, n_replicates):
+        brownians = generate_brownians(
+            n_paths, n_variables=2, times=process.times, n_processes=n_processes, seed=replicate_seed,
+            layout=layout, dtype=dtype,
+            correlation=process.correlation_matrix(), factorization=factorization, ordering=ordering
+        )
+        values.append(np.mean(_storage_path_values(initial_volume, max_volume, process, brownians, layout)))
+
+    return replicate_estimate(values, n_paths)
+
+
+def streaming_value_storage_unit(
+        initial_volume: int,
+        max_volume: int,
+        process: CombinedPriceProcess,
+        tol: float = None,
+        max_time: float = None,
+        max_paths: int = None,
+        chunk_size: int = 1024,
+        dtype=float,
+        factorization: Factorization = Factorization.CHOLESKY,
+        ordering: DimensionOrdering = DimensionOrdering.INTERLEAVED) -> MonteCarloEstimate:
+    # Each chunk is valued with its own regressions, so chunk_size has to be large enough for
+    # them to be stable. The chunk values are the independent estimates behind the error bar.
+    layout = BrownianLayout.TIME_MAJOR
+
+    def chunk_samples(start: int, n_paths: int):
+        brownians = generate_brownians(
+            n_paths, n_variables=2, times=process.times, start=start, layout=layout, dtype=dtype,
+            correlation=process.correlation_matrix(), factorization=factorization, ordering=ordering
+        )
+        return _storage_path_values(initial_volume, max_volume, process, brownians, layout)
+
+    return streaming_estimate(chunk_samples, chunk_size, tol, max_time, max_paths, chunk_errors=True)
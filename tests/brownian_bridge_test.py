@@ -3,6 +3,8 @@ import unittest
 from models.brownian_bridge import BrownianBridge
 import numpy as np
 
+from scipy.special import ndtri
+
 from tests.pimpedrandom import PimpedRandom
 from tests.test_utils import random_times
 
@@ -39,3 +41,102 @@ class BrownianBridgeTests(unittest.TestCase):
                     delta=0.02,
                     msg=f"Seed = {seed}"
                 )
+
+    def test_batch_matches_single_paths(self):
+        rng = PimpedRandom()
+        for _ in range(10):
+            seed = np.random.randint(0, 100 * 1000)
+            rng.seed(seed)
+            n_times = np.random.randint(1, 50)
+            times = random_times(rng, n_times)
+            n_paths = 100
+            uniforms = np.random.rand(n_times, n_paths)
+            bldr = BrownianBridge(times)
+            reference = _StepMapBridge(times)
+
+            np.testing.assert_array_equal(bldr.left_index, reference.left_index, err_msg=f"Seed = {seed}")
+            np.testing.assert_array_equal(bldr.bridge_index, reference.bridge_index, err_msg=f"Seed = {seed}")
+            np.testing.assert_array_equal(bldr.right_index, reference.right_index, err_msg=f"Seed = {seed}")
+            np.testing.assert_allclose(bldr.left_weight, reference.left_weight, err_msg=f"Seed = {seed}")
+            np.testing.assert_allclose(bldr.right_weight, reference.right_weight, err_msg=f"Seed = {seed}")
+            np.testing.assert_allclose(bldr.stddev, reference.stddev, err_msg=f"Seed = {seed}")
+
+            paths = bldr.generate_batch(uniforms)
+
+            self.assertEqual(paths.shape, (n_times, n_paths))
+            for i_path in range(n_paths):
+                np.testing.assert_allclose(
+                    paths[:, i_path],
+                    reference.generate(uniforms[:, i_path]),
+                    rtol=1e-12, atol=1e-12,
+                    err_msg=f"Seed = {seed}"
+                )
+
+
+class _StepMapBridge:
+    # The bridge as it was built and walked before batching: a linear scan of step_map for
+    # the next unfilled gap, then one path at a time
+    def __init__(self, times):
+        self.times = times
+        n_times = len(times)
+        self.n_times = n_times
+
+        step_map = np.zeros((n_times,), int)
+        self.left_index = np.zeros((n_times,), int)
+        self.bridge_index = np.zeros((n_times,), int)
+        self.right_index = np.zeros((n_times,), int)
+        self.left_weight = np.zeros((n_times,), float)
+        self.right_weight = np.zeros((n_times,), float)
+        self.stddev = np.zeros((n_times,), float)
+
+        step_map[n_times - 1] = 1
+        self.bridge_index[0] = n_times - 1
+        self.stddev[0] = np.sqrt(times[n_times - 1])
+
+        def index_where(pred, values, i_start):
+            for i, v in enumerate(values[i_start:]):
+                if pred(v):
+                    return i + i_start
+            return -1
+
+        j = 0
+        for i in range(1, n_times):
+            j = index_where(lambda n: n == 0, step_map, j)
+            k = index_where(lambda n: n != 0, step_map, j)
+            l = j + ((k - 1 - j) >> 1)
+
+            step_map[l] = i
+            self.bridge_index[i] = l
+            self.left_index[i] = j
+            self.right_index[i] = k
+
+            t_left = times[j - 1] if j > 0 else 0.0
+            if times[k] == t_left:
+                self.left_weight[i] = 1.0
+            else:
+                self.left_weight[i] = (times[k] - times[l]) / (times[k] - t_left)
+            self.stddev[i] = np.sqrt((times[l] - t_left) * self.left_weight[i])
+            self.right_weight[i] = 1.0 - self.left_weight[i]
+
+            j = k + 1
+            if j >= n_times:
+                j = 0
+
+    def generate(self, uniform_sample):
+        normal_sample = ndtri(uniform_sample)
+        path = np.zeros((self.n_times,), float)
+        path[self.n_times - 1] = self.stddev[0] * normal_sample[0]
+
+        for i_time in range(1, self.n_times):
+            j = self.left_index[i_time]
+            k = self.right_index[i_time]
+            l = self.bridge_index[i_time]
+
+            if j > 0:
+                path[l] = self.left_weight[i_time] * path[j - 1] + \
+                          self.right_weight[i_time] * path[k] + \
+                          self.stddev[i_time] * normal_sample[i_time]
+            else:
+                path[l] = self.right_weight[i_time] * path[k] + self.stddev[i_time] * normal_sample[i_time]
+
+        return path
@@ -1,6 +1,7 @@
 import numpy as np
 
-from models.brownian_generator import generate_brownians
+from models.brownian_generator import BrownianLayout, DimensionOrdering, Factorization, brownians_at, \
+    generate_brownians, generate_brownians_in_chunks, sobol_dimensions
 from tests.pimpedrandom import PimpedRandom
 from tests.stats_test_mixin import StatsTestMixin
 from tests.test_utils import random_times
@@ -53,3 +54,111 @@ class BrownianGeneratorTest(StatsTestMixin):
                             tol=0.03,
                             msg=f"Seed = {seed}"
                         )
+
+    def test_process_pool_matches_single_process(self):
+        rng = PimpedRandom()
+        seed = np.random.randint(0, 100 * 1000)
+        rng.seed(seed)
+
+        n_paths = rng.randint(100, 1000)
+        n_variables = rng.randint(1, 3)
+        times = random_times(rng, rng.randint(1, 20))
+
+        np.testing.assert_array_equal(
+            generate_brownians(n_paths, n_variables, times, n_processes=3),
+            generate_brownians(n_paths, n_variables, times),
+            err_msg=f"Seed = {seed}"
+        )
+
+    def test_time_major_layout(self):
+        rng = PimpedRandom()
+        seed = np.random.randint(0, 100 * 1000)
+        rng.seed(seed)
+
+        n_paths = rng.randint(100, 1000)
+        n_variables = rng.randint(1, 3)
+        n_times = rng.randint(1, 20)
+        times = random_times(rng, n_times)
+
+        path_major = generate_brownians(n_paths, n_variables, times)
+        out = np.zeros((n_times, n_variables, n_paths), np.float32)
+        time_major = generate_brownians(
+            n_paths, n_variables, times, layout=BrownianLayout.TIME_MAJOR, dtype=np.float32, out=out
+        )
+
+        self.assertIs(time_major, out)
+        for i_time in range(n_times):
+            self.assertTrue(brownians_at(time_major, i_time, BrownianLayout.TIME_MAJOR).flags.c_contiguous)
+            np.testing.assert_allclose(
+                brownians_at(time_major, i_time, BrownianLayout.TIME_MAJOR),
+                brownians_at(path_major, i_time),
+                atol=1e-5,
+                err_msg=f"Seed = {seed}"
+            )
+
+    def test_correlated_factors(self):
+        rng = PimpedRandom()
+
+        for factorization in Factorization:
+            for ordering in DimensionOrdering:
+                seed = np.random.random()
+                rng.seed(seed)
+
+                n_paths = 1024 << 2
+                n_variables = 3
+                times = random_times(rng, rng.randint(1, 6))
+                a = np.array([rng.uniform(-1.0, 1.0) for _ in range(n_variables * n_variables)])
+                a = a.reshape(n_variables, n_variables)
+                covariance = np.matmul(a, np.transpose(a)) + 0.1 * np.eye(n_variables)
+                std_devs = np.sqrt(np.diag(covariance))
+                correlation = covariance / np.outer(std_devs, std_devs)
+
+                brownians = generate_brownians(
+                    n_paths, n_variables, times, correlation=correlation, factorization=factorization, ordering=ordering
+                )
+
+                for i_time in range(len(times)):
+                    for i_var in range(n_variables):
+                        sample_i = brownians[:, i_var, i_time]
+                        self.check_std_dev(sample_i, np.sqrt(times[i_time]), tol=0.03, msg=f"Seed = {seed}")
+                        for j_var in range(i_var + 1, n_variables):
+                            self.assertAlmostEqual(
+                                np.corrcoef(sample_i, brownians[:, j_var, i_time])[0, 1],
+                                correlation[i_var, j_var],
+                                delta=0.03,
+                                msg=f"Seed = {seed}"
+                            )
+
+    def test_sobol_dimensions_are_a_permutation(self):
+        rng = PimpedRandom()
+
+        for _ in range(10):
+            seed = np.random.random()
+            rng.seed(seed)
+            n_variables = rng.randint(1, 4)
+            n_times = rng.randint(1, 20)
+            factor_variances = np.array(sorted([rng.random() for _ in range(n_variables)], reverse=True))
+            step_variances = np.array([rng.random() for _ in range(n_times)])
+
+            for ordering in DimensionOrdering:
+                dimensions = sobol_dimensions(factor_variances, step_variances, ordering)
+                self.assertEqual(dimensions.shape, (n_variables, n_times))
+                np.testing.assert_array_equal(np.sort(dimensions.ravel()), np.arange(n_variables * n_times))
+
+            dimensions = sobol_dimensions(factor_variances, step_variances, DimensionOrdering.IMPORTANCE)
+            importance = np.outer(factor_variances, step_variances)
+            self.assertEqual(dimensions.ravel()[np.argmax(importance)], 0, msg=f"Seed = {seed}")
+
+    def test_chunked_generation_matches_single_call(self):
+        rng = PimpedRandom()
+        seed = np.random.randint(0, 100 * 1000)
+        rng.seed(seed)
+        times = random_times(rng, rng.randint(1, 20)) + 0.01
+        correlation = np.array([[1.0, 0.6], [0.6, 1.0]])
+
+        for layout in BrownianLayout:
+            expected = generate_brownians(1000, 2, times, layout=layout, correlation=correlation)
+            chunked = generate_brownians_in_chunks(
+                np.zeros(expected.shape), 2, times, chunk_size=96, layout=layout, correlation=correlation
+            )
+            np.testing.assert_array_equal(chunked, expected, err_msg=f"Seed = {seed}")
@@ -1,7 +1,9 @@
 import unittest
 from datetime import timedelta
 
-from models.day import Day
+import numpy as np
+
+from models.day import Day, DayArray
 
 
 class RichDateTest(unittest.TestCase):
@@ -37,3 +39,34 @@ class RichDateTest(unittest.TestCase):
             10.0 / 365.25,
             1e03
         )
+
+    def test_day_array_arithmetic(self):
+        days = [Day(2000, 2, 28), Day(2000, 12, 31), Day(2001, 3, 1)]
+        day_array = DayArray(days)
+        self.assertEqual(list(day_array + 2), [d + 2 for d in days])
+        self.assertEqual(list(day_array - 2), [d - 2 for d in days])
+        self.assertEqual(list(day_array + timedelta(3)), [d + timedelta(3) for d in days])
+        self.assertEqual(list(day_array + np.array([1, 2, 3])), [d + i for d, i in zip(days, [1, 2, 3])])
+        self.assertEqual(list(day_array - Day(2000, 1, 1)), [(d - Day(2000, 1, 1)).days for d in days])
+        self.assertIsInstance(day_array[0], Day)
+        self.assertTrue(np.all(day_array == days))
+
+    def test_day_array_time_since(self):
+        market_day = Day(2000, 1, 1)
+        days = [market_day + i for i in range(0, 1000, 37)]
+        np.testing.assert_allclose(DayArray(days).time_since(market_day), [d.time_since(market_day) for d in days])
+
+    def test_day_array_datetime64(self):
+        days = np.array(["2000-02-28", "2000-03-01"], "datetime64[D]")
+        day_array = DayArray(days)
+        np.testing.assert_array_equal(day_array.as_datetime64(), days)
+        self.assertEqual(day_array[1], Day(2000, 3, 1))
+        np.testing.assert_array_equal(DayArray(day_array.day_numbers).as_datetime64(), days)
+
+    def test_schedule(self):
+        schedule = DayArray.schedule(Day(2000, 1, 30), Day(2000, 3, 2))
+        self.assertEqual(len(schedule), 33)
+        self.assertEqual(schedule[0], Day(2000, 1, 30))
+        self.assertEqual(schedule[-1], Day(2000, 3, 2))
+        self.assertEqual(list(DayArray.schedule(Day(2000, 1, 1), Day(2000, 1, 10), step=3)),
+                         [Day(2000, 1, 1), Day(2000, 1, 4), Day(2000, 1, 7), Day(2000, 1, 10)])
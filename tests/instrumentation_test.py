@@ -0,0 +1,52 @@
+import io
+import json
+import unittest
+
+import numpy as np
+
+from models import instrumentation
+from models.day import Day
+from models.option import ExerciseStyle, OptionRight
+from models.option_instrument import OptionInstrument
+from models.storage_model import CombinedPriceProcess, value_storage_unit
+
+
+class InstrumentationTest(unittest.TestCase):
+
+    def tearDown(self):
+        instrumentation.disable()
+
+    def test_disabled_records_nothing(self):
+        self.assertFalse(instrumentation.enabled())
+        self.assertIs(instrumentation.timer("a"), instrumentation.timer("b"))
+        with instrumentation.timer("a"):
+            instrumentation.count("b")
+
+    def test_storage_stages(self):
+        sink = instrumentation.enable(instrumentation.InMemorySink())
+        times = np.array([0.25, 0.5, 0.75])
+        process = CombinedPriceProcess(np.array([10.0, 12.0, 11.0]), times, sigma=0.3, tilt_vol=0.5)
+        value_storage_unit(1, 2, process, n_paths=256)
+
+        report = sink.report()
+        for name in ["paths.generate", "sobol.generate", "bridge.generate", "storage.regression",
+                     "storage.decision"]:
+            self.assertIn(name, report["timers"])
+        self.assertEqual(report["timers"]["storage.regression"]["calls"], 3)
+        self.assertEqual(report["counters"]["storage.paths"], 256)
+        self.assertEqual(report["counters"]["sobol.points"], 256)
+        self.assertEqual(report["counters"]["bridge.paths"], 2 * 256)
+
+        sink.reset()
+        self.assertEqual(sink.report(), {"timers": {}, "counters": {}})
+
+    def test_json_lines(self):
+        stream = io.StringIO()
+        instrumentation.enable(instrumentation.JsonLinesSink(stream))
+        option = OptionInstrument(100.0, OptionRight.PUT, Day(2018, 6, 1), ExerciseStyle.AMERICAN)
+        option.cn_value(Day(2018, 1, 1), 100.0, 0.3, 0.05)
+
+        events = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([(e["type"], e["name"]) for e in events], [("timer", "cn.solve"), ("counter", "cn.columns")])
+        self.assertGreater(events[0]["seconds"], 0.0)
+        self.assertEqual(events[1]["count"], 1)
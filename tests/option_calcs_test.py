@@ -6,7 +6,14 @@ from models.day import Day
 from models.option import ExerciseStyle
 from models.option_instrument import OptionInstrument
 from tests.pimpedrandom import PimpedRandom
-from models.option_calcs import OptionRight
+from models.option_calcs import OptionRight, randomized_monte_carlo_european_value, black_scholes, \
+    black_scholes_greeks, intrinsic_value, intrinsic_values, crank_nicholson_operator, crank_nicholson_value, \
+    crank_nicholson_values, crank_nicholson_greeks, black_scholes_values, implied_vols, ControlVariate, \
+    monte_carlo_european_estimate, streaming_monte_carlo_european_value, barone_adesi_whaley_values, \
+    barone_adesi_whaley_error_bounds, crank_nicholson_grid_values, _european_samples
+from models.brownian_generator import generate_brownians
+from models.option import AmericanMethod, right_codes
+from models.option_instrument import set_american_method
 
 
 def random_option(
@@ -120,3 +127,369 @@ class OptionCalcsTest(unittest.TestCase):
             bs_value = option.european_value(market_day, fwd_price, sigma, r)
 
             self.assertAlmostEqual(mc_value, bs_value, delta=0.1, msg=f"Seesd was {seed}")
+
+    def test_randomized_mc_error_bar(self):
+        rng = PimpedRandom()
+
+        for _ in range(5):
+            seed = np.random.randint(0, 100 * 1000)
+            rng.seed(seed)
+
+            market_day = Day(2018, 1, 1)
+            option = random_option(rng, ex_style=ExerciseStyle.EUROPEAN)
+            fwd_price = rng.uniform(option.strike - 1.0, option.strike + 1.0)
+            sigma = 0.05 + rng.random() * 0.45
+            r = 0.1 * rng.random()
+            t = option.expiry.time_since(market_day)
+
+            estimate = randomized_monte_carlo_european_value(
+                option.right, option.strike, fwd_price, sigma, r, t, n_paths=1024, n_replicates=16, seed=seed
+            )
+            bs_value = option.european_value(market_day, fwd_price, sigma, r)
+
+            self.assertEqual(estimate.n_paths, 1024 * 16)
+            self.assertGreater(estimate.std_err, 0.0)
+            self.assertAlmostEqual(estimate.value, bs_value, delta=5.0 * estimate.std_err + 1e-4, msg=f"Seed was {seed}")
+
+    def test_mc_variance_reduction(self):
+        market_day = Day(2018, 1, 1)
+        for right in OptionRight:
+            option = OptionInstrument(95.0, right, Day(2018, 7, 1), ExerciseStyle.EUROPEAN)
+            bs_value = option.european_value(market_day, 100.0, 0.3, 0.05)
+
+            plain = option.mc_european_estimate(market_day, 100.0, 0.3, 0.05, n_paths=4096)
+            for antithetic in (False, True):
+                for control_variate in (ControlVariate.FORWARD, ControlVariate.VANILLA):
+                    estimate = option.mc_european_estimate(
+                        market_day, 100.0, 0.3, 0.05, n_paths=4096, antithetic=antithetic,
+                        control_variate=control_variate
+                    )
+                    self.assertEqual(estimate.n_paths, 4096)
+                    self.assertLess(estimate.std_err, plain.std_err)
+                    self.assertAlmostEqual(estimate.value, bs_value, delta=4.0 * estimate.std_err + 1e-4)
+
+    def test_control_variate_std_err_charges_for_beta(self):
+        brownians = generate_brownians(1000, 1, np.array([0.5]))[:, 0, 0]
+        for control_variate in ControlVariate:
+            estimate = monte_carlo_european_estimate(
+                OptionRight.CALL, 100.0, 101.0, 0.2, 0.0, 0.5, n_paths=1000, control_variate=control_variate
+            )
+            samples = _european_samples(OptionRight.CALL, 100.0, 101.0, 0.2, 0.5, brownians, False, control_variate)
+            ddof = 1 if control_variate is ControlVariate.NONE else 2
+            self.assertAlmostEqual(estimate.std_err, np.std(samples, ddof=ddof) / np.sqrt(1000), delta=1e-14)
+
+    def test_randomized_mc_with_control_variate(self):
+        option = OptionInstrument(105.0, OptionRight.PUT, Day(2018, 7, 1), ExerciseStyle.EUROPEAN)
+        market_day = Day(2018, 1, 1)
+        t = option.expiry.time_since(market_day)
+        bs_value = option.european_value(market_day, 100.0, 0.3, 0.05)
+        for control_variate in ControlVariate:
+            estimate = randomized_monte_carlo_european_value(
+                option.right, option.strike, 100.0, 0.3, 0.05, t, n_paths=1024, n_replicates=16, seed=1,
+                antithetic=True, control_variate=control_variate
+            )
+            self.assertEqual(estimate.n_paths, 1024 * 16)
+            self.assertAlmostEqual(estimate.value, bs_value, delta=5.0 * estimate.std_err + 1e-4)
+
+    def test_streaming_mc_matches_fixed_size(self):
+        args = (OptionRight.CALL, 100.0, 102.0, 0.25, 0.03, 0.75)
+        fixed = monte_carlo_european_estimate(*args, n_paths=10000)
+        streamed = streaming_monte_carlo_european_value(*args, max_paths=10000, chunk_size=1536)
+        self.assertEqual(streamed.n_paths, 10000)
+        self.assertAlmostEqual(streamed.value, fixed.value, delta=1e-12)
+        self.assertAlmostEqual(streamed.std_err, fixed.std_err, delta=1e-12)
+
+    def test_streaming_mc_stops_at_tolerance(self):
+        args = (OptionRight.PUT, 100.0, 98.0, 0.3, 0.02, 1.0)
+        bs_value = black_scholes(OptionRight.PUT, 100.0, 98.0, 0.3, 1.0) * np.exp(-0.02)
+        for antithetic, control_variate in ((False, ControlVariate.NONE), (True, ControlVariate.VANILLA)):
+            estimate = streaming_monte_carlo_european_value(
+                *args, tol=0.02, max_paths=10 ** 7, chunk_size=1024, antithetic=antithetic,
+                control_variate=control_variate
+            )
+            self.assertLessEqual(estimate.std_err, 0.02)
+            self.assertLess(estimate.n_paths, 10 ** 7)
+            self.assertAlmostEqual(estimate.value, bs_value, delta=4.0 * estimate.std_err)
+
+    def test_mc_greeks_close_to_black_scholes(self):
+        market_day = Day(2018, 1, 1)
+        for right in OptionRight:
+            for antithetic in (False, True):
+                option = OptionInstrument(95.0, right, Day(2018, 7, 1), ExerciseStyle.EUROPEAN)
+                mc = option.mc_greeks(market_day, 100.0, 0.3, 0.05, n_paths=2 ** 16, antithetic=antithetic)
+                bs = option.european_greeks(market_day, 100.0, 0.3, 0.05)
+                self.assertAlmostEqual(mc.value, bs.value, delta=0.01)
+                self.assertAlmostEqual(mc.delta, bs.delta, delta=1e-3)
+                self.assertAlmostEqual(mc.gamma, bs.gamma, delta=0.01 * bs.gamma)
+                self.assertAlmostEqual(mc.vega, bs.vega, delta=0.01 * bs.vega)
+                self.assertAlmostEqual(mc.theta, bs.theta, delta=0.01 * abs(bs.theta))
+
+    def test_vectorized_black_scholes_matches_scalar(self):
+        rng = PimpedRandom()
+        seed = np.random.randint(0, 100 * 1000)
+        rng.seed(seed)
+
+        n_options = 200
+        rights = [rng.enum_choice(OptionRight) for _ in range(n_options)]
+        strikes = np.array([rng.uniform(80.0, 120.0) for _ in range(n_options)])
+        fwd_prices = np.array([rng.uniform(80.0, 120.0) for _ in range(n_options)])
+        sigmas = np.array([rng.uniform(0.01, 0.6) for _ in range(n_options)])
+        ts = np.array([rng.uniform(0.01, 2.0) for _ in range(n_options)])
+
+        greeks = black_scholes_greeks(right_codes(rights), strikes, fwd_prices, sigmas, ts)
+        intrinsics = intrinsic_values(right_codes(rights), strikes, fwd_prices)
+
+        for i, right in enumerate(rights):
+            def bs(f=fwd_prices[i], s=sigmas[i], t=ts[i]):
+                return black_scholes(right, strikes[i], f, s, t)
+
+            # Price steps scale with the terminal standard deviation so short, low vol options stay resolved
+            h = 1e-3 * fwd_prices[i] * sigmas[i] * np.sqrt(ts[i])
+            self.assertAlmostEqual(greeks.value[i], bs(), delta=1e-10, msg=f"Seed was {seed}")
+            self.assertAlmostEqual(intrinsics[i], intrinsic_value(right, strikes[i], fwd_prices[i]), delta=1e-12)
+            self.assertAlmostEqual(
+                greeks.delta[i], (bs(f=fwd_prices[i] + h) - bs(f=fwd_prices[i] - h)) / (2 * h), delta=1e-5,
+                msg=f"Seed was {seed}"
+            )
+            self.assertAlmostEqual(
+                greeks.gamma[i], (bs(f=fwd_prices[i] + h) - 2 * bs() + bs(f=fwd_prices[i] - h)) / (h * h),
+                delta=1e-4 * (1.0 + abs(greeks.gamma[i])), msg=f"Seed was {seed}"
+            )
+            self.assertAlmostEqual(
+                greeks.vega[i], (bs(s=sigmas[i] + 1e-6) - bs(s=sigmas[i] - 1e-6)) / 2e-6,
+                delta=1e-4 * (1.0 + abs(greeks.vega[i]))
+            )
+            self.assertAlmostEqual(
+                greeks.theta[i], -(bs(t=ts[i] + 1e-6) - bs(t=ts[i] - 1e-6)) / 2e-6,
+                delta=1e-4 * (1.0 + abs(greeks.theta[i]))
+            )
+
+    def test_vectorized_black_scholes_limits(self):
+        strikes = np.array([90.0, 100.0, 110.0])
+        for right in OptionRight:
+            for sigma, t in [(0.0, 1.0), (0.2, 0.0), (0.0, 0.0)]:
+                greeks = black_scholes_greeks(right.value, strikes, 100.0, sigma, t)
+                for values in [greeks.value, greeks.delta, greeks.gamma, greeks.vega, greeks.theta]:
+                    self.assertFalse(np.any(np.isnan(values)))
+                np.testing.assert_array_equal(greeks.value, intrinsic_values(right.value, strikes, 100.0))
+
+    def test_european_value_over_arrays(self):
+        market_day = Day(2018, 1, 1)
+        option = OptionInstrument(100.0, OptionRight.PUT, Day(2018, 6, 1), ExerciseStyle.EUROPEAN)
+        fwd_prices = np.array([90.0, 100.0, 110.0])
+        values = option.european_value(market_day, fwd_prices, 0.3, 0.05)
+        for fwd_price, value in zip(fwd_prices, values):
+            self.assertAlmostEqual(value, option.european_value(market_day, fwd_price, 0.3, 0.05), delta=1e-10)
+
+    def test_crank_nicholson_operator_matches_dense_matrices(self):
+        n, dz, dt = 20, 0.3, 0.01
+        a = 1.0 / (dz * dz)
+        m1 = np.zeros((n, n), float)
+        m2 = np.zeros((n, n), float)
+        for i in range(1, n - 1):
+            m1[i, i - 1:i + 2] = [a / 2, 2.0 / dt - a, a / 2]
+            m2[i, i - 1:i + 2] = [-a / 2, 2.0 / dt + a, -a / 2]
+        m1[0, 0] = m1[n - 1, n - 1] = m2[0, 0] = m2[n - 1, n - 1] = 1.0
+
+        operator = crank_nicholson_operator(n, dz, dt)
+        self.assertIs(operator, crank_nicholson_operator(n, dz, dt))
+
+        vec = np.random.rand(n)
+        rhs = operator.apply_explicit(vec, np.zeros((n,), float))
+        np.testing.assert_allclose(rhs, np.matmul(m1, vec), rtol=1e-12)
+        np.testing.assert_allclose(operator.solve(rhs), np.linalg.solve(m2, np.matmul(m1, vec)), rtol=1e-10)
+
+    def test_american_cn_converges_on_fine_grids(self):
+        rng = PimpedRandom()
+
+        for _ in range(3):
+            seed = np.random.randint(0, 100 * 1000)
+            rng.seed(seed)
+
+            right = rng.enum_choice(OptionRight)
+            strike = rng.uniform(80.0, 120.0)
+            fwd_price = rng.uniform(strike - 5.0, strike + 5.0)
+            sigma = 0.1 + rng.random() * 0.4
+            r = 0.1 * rng.random()
+            t = 0.1 + rng.random()
+
+            def value(n):
+                return crank_nicholson_value(right, ExerciseStyle.AMERICAN, strike, fwd_price, sigma, r, t, n, n, 4)
+
+            self.assertAlmostEqual(value(1000), value(250), delta=0.01, msg=f"Seed was {seed}")
+
+    def test_batch_cn_matches_single_option_values(self):
+        rng = PimpedRandom()
+        seed = np.random.randint(0, 100 * 1000)
+        rng.seed(seed)
+
+        n_options = 20
+        rights = [rng.enum_choice(OptionRight) for _ in range(n_options)]
+        strikes = np.array([rng.uniform(80.0, 120.0) for _ in range(n_options)])
+        fwd_price = 100.0
+        sigma = 0.1 + rng.random() * 0.4
+        r = 0.1 * rng.random()
+        t = 0.1 + rng.random()
+
+        for ex_style in ExerciseStyle:
+            values = crank_nicholson_values(
+                right_codes(rights), ex_style, strikes, fwd_price, sigma, r, t, 100, 100, 4
+            )
+            for right, strike, value in zip(rights, strikes, values):
+                self.assertAlmostEqual(
+                    value,
+                    crank_nicholson_value(right, ex_style, strike, fwd_price, sigma, r, t, 100, 100, 4),
+                    delta=1e-10,
+                    msg=f"Seed was {seed}"
+                )
+
+    def test_cn_grid_values(self):
+        rights = right_codes([OptionRight.CALL, OptionRight.PUT])
+        relative_prices, columns = crank_nicholson_grid_values(
+            rights, ExerciseStyle.AMERICAN, [90.0, 110.0], 0.25, 0.03, 0.8, 100, 100, 4
+        )
+        self.assertEqual(columns.shape, (100, 2))
+        i_mid = 50
+        np.testing.assert_allclose(
+            columns[i_mid],
+            crank_nicholson_values(rights, ExerciseStyle.AMERICAN, [90.0, 110.0],
+                                   relative_prices[i_mid] * np.array([90.0, 110.0]), 0.25, 0.03, 0.8, 100, 100, 4),
+            rtol=1e-12
+        )
+
+    def test_cn_greeks_close_to_black_scholes(self):
+        rng = PimpedRandom()
+
+        for _ in range(5):
+            seed = np.random.randint(0, 100 * 1000)
+            rng.seed(seed)
+
+            right = rng.enum_choice(OptionRight)
+            strike = rng.uniform(80.0, 120.0)
+            fwd_price = rng.uniform(strike - 5.0, strike + 5.0)
+            sigma = 0.1 + rng.random() * 0.4
+            r = 0.1 * rng.random()
+            t = 0.1 + rng.random()
+            disc = np.exp(-r * t)
+
+            numeric = crank_nicholson_greeks(
+                right.value, ExerciseStyle.EUROPEAN, strike, fwd_price, sigma, r, t, 400, 400, 5
+            )
+            analytic = black_scholes_greeks(right.value, strike, fwd_price, sigma, t)
+
+            def check(x, expected, tol):
+                self.assertAlmostEqual(x[0], expected * disc, delta=tol * (1.0 + abs(expected)), msg=f"Seed was {seed}")
+
+            check(numeric.value, analytic.value, 1e-3)
+            check(numeric.delta, analytic.delta, 1e-3)
+            check(numeric.gamma, analytic.gamma, 1e-3)
+            check(numeric.vega, analytic.vega, 1e-2)
+            check(numeric.theta, analytic.theta + r * analytic.value, 1e-2)
+
+        with self.assertRaisesRegex(Exception, "three time layers"):
+            crank_nicholson_greeks(OptionRight.PUT.value, ExerciseStyle.EUROPEAN, 100.0, 100.0, 0.2, 0.0, 1.0, 50, 2, 4)
+
+    def test_instrument_cn_greeks(self):
+        market_day = Day(2018, 1, 1)
+        option = OptionInstrument(100.0, OptionRight.PUT, Day(2018, 6, 1), ExerciseStyle.AMERICAN)
+        greeks = option.cn_greeks(market_day, 100.0, 0.3, 0.05)
+        self.assertAlmostEqual(greeks.value, option.cn_value(market_day, 100.0, 0.3, 0.05), delta=1e-10)
+        self.assertLess(greeks.delta, 0.0)
+        self.assertGreater(greeks.gamma, 0.0)
+        self.assertGreater(greeks.vega, 0.0)
+
+    def test_implied_vols_round_trip(self):
+        rng = np.random.default_rng(1234)
+        n = 1000
+        rights = rng.integers(1, 4, n)
+        strikes = rng.uniform(60.0, 140.0, n)
+        fwd_prices = rng.uniform(80.0, 120.0, n)
+        sigmas = rng.uniform(0.05, 1.0, n)
+        ts = rng.uniform(0.05, 2.0, n)
+        prices = black_scholes_values(rights, strikes, fwd_prices, sigmas, ts)
+        vegas = black_scholes_greeks(rights, strikes, fwd_prices, sigmas, ts).vega
+
+        vols, converged = implied_vols(rights, prices, strikes, fwd_prices, ts)
+        well_posed = vegas > 1e-3
+        self.assertTrue(np.all(converged[well_posed]))
+        np.testing.assert_allclose(vols[well_posed], sigmas[well_posed], atol=1e-8)
+
+    def test_implied_vols_outside_arbitrage_bounds(self):
+        vols, converged = implied_vols(
+            right_codes([OptionRight.CALL] * 3), [0.0, 5.0, 150.0], 100.0, 100.0, 1.0
+        )
+        self.assertTrue(np.isnan(vols[0]) and np.isnan(vols[2]))
+        self.assertFalse(converged[0] or converged[2])
+        self.assertTrue(converged[1])
+        self.assertAlmostEqual(black_scholes(OptionRight.CALL, 100.0, 100.0, vols[1], 1.0), 5.0, delta=1e-9)
+
+    def test_barone_adesi_whaley_close_to_crank_nicholson(self):
+        rng = np.random.default_rng(7)
+        n_options = 50
+        rights = rng.integers(1, 3, n_options)
+        strikes = rng.uniform(90.0, 110.0, n_options)
+        fwd_prices = rng.uniform(90.0, 110.0, n_options)
+        sigmas = rng.uniform(0.1, 0.4, n_options)
+        ts = rng.uniform(0.1, 1.0, n_options)
+        rs = rng.uniform(0.0, 0.1, n_options)
+
+        values, converged = barone_adesi_whaley_values(rights, strikes, fwd_prices, sigmas, ts, rs)
+        self.assertGreater(np.count_nonzero(converged), 10)
+        self.assertFalse(np.all(converged))
+        for i in np.flatnonzero(converged):
+            cn_value = crank_nicholson_value(
+                OptionRight(int(rights[i])), ExerciseStyle.AMERICAN, strikes[i], fwd_prices[i], sigmas[i], rs[i],
+                ts[i], 400, 400, 5
+            )
+            # Within the calibrated domain the approximation is good to tol, here 1%, of max(value, K / 100)
+            self.assertAlmostEqual(values[i], cn_value, delta=0.01 * max(cn_value, strikes[i] / 100.0) + 1e-3)
+
+    def test_barone_adesi_whaley_accuracy_gate(self):
+        # Long dated at a high rate the approximation is several percent off and goes to Crank-Nicolson
+        market_day = Day(2018, 1, 1)
+        put = OptionInstrument(100.0, OptionRight.PUT, Day(2023, 1, 1), ExerciseStyle.AMERICAN)
+        t = put.expiry.time_since(market_day)
+        values, converged = barone_adesi_whaley_values(OptionRight.PUT.value, 100.0, 120.0, 0.3, t, 0.1)
+        self.assertFalse(converged)
+        cn_value = crank_nicholson_value(OptionRight.PUT, ExerciseStyle.AMERICAN, 100.0, 120.0, 0.3, 0.1, t,
+                                         400, 400, 6)
+        self.assertGreater(values, 1.05 * cn_value)
+        self.assertEqual(
+            put.value(market_day, 120.0, 0.3, 0.1, american_method=AmericanMethod.BARONE_ADESI_WHALEY),
+            put.cn_value(market_day, 120.0, 0.3, 0.1)
+        )
+
+        # A looser tol widens the domain, outside the calibration nothing is accepted
+        self.assertTrue(barone_adesi_whaley_values(OptionRight.PUT.value, 100.0, 120.0, 0.3, t, 0.1, tol=0.5)[1])
+        self.assertFalse(barone_adesi_whaley_values(OptionRight.PUT.value, 100.0, 120.0, 0.3, 10.0, 0.1, tol=0.5)[1])
+        self.assertTrue(np.isinf(barone_adesi_whaley_error_bounds(0.6, 0.1)))
+
+    def test_barone_adesi_whaley_limits(self):
+        # No early exercise premium without rates, straddles are not covered
+        values, converged = barone_adesi_whaley_values(
+            right_codes(list(OptionRight)), 100.0, 95.0, 0.3, 1.0, [0.0, 0.0, 0.05]
+        )
+        np.testing.assert_allclose(values[:2], black_scholes_values(right_codes(list(OptionRight))[:2], 100.0, 95.0,
+                                                                    0.3, 1.0))
+        self.assertTrue(np.isnan(values[2]))
+        np.testing.assert_array_equal(converged, [True, True, False])
+
+    def test_instrument_american_method(self):
+        market_day = Day(2018, 1, 1)
+        put = OptionInstrument(100.0, OptionRight.PUT, Day(2018, 7, 1), ExerciseStyle.AMERICAN)
+        straddle = OptionInstrument(100.0, OptionRight.STRADDLE, Day(2018, 7, 1), ExerciseStyle.AMERICAN)
+        cn_value = put.cn_value(market_day, 95.0, 0.3, 0.05)
+        baw_value = put.value(market_day, 95.0, 0.3, 0.05, american_method=AmericanMethod.BARONE_ADESI_WHALEY)
+        self.assertNotEqual(baw_value, cn_value)
+        self.assertAlmostEqual(baw_value, cn_value, delta=0.05)
+        self.assertEqual(
+            straddle.value(market_day, 95.0, 0.3, 0.05, american_method=AmericanMethod.BARONE_ADESI_WHALEY),
+            straddle.cn_value(market_day, 95.0, 0.3, 0.05)
+        )
+
+        set_american_method(AmericanMethod.BARONE_ADESI_WHALEY)
+        try:
+            self.assertEqual(put.value(market_day, 95.0, 0.3, 0.05), baw_value)
+        finally:
+            set_american_method(AmericanMethod.CRANK_NICHOLSON)
+        self.assertEqual(put.value(market_day, 95.0, 0.3, 0.05), cn_value)
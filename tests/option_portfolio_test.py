@@ -0,0 +1,57 @@
+import unittest
+
+import numpy as np
+
+from models.day import Day
+from models.option import AmericanMethod, OptionRight
+from models.option_portfolio import OptionPortfolio
+from tests.option_calcs_test import random_option
+from tests.pimpedrandom import PimpedRandom
+
+
+class OptionPortfolioTest(unittest.TestCase):
+
+    def random_book(self, seed, n_options):
+        rng = PimpedRandom()
+        rng.seed(seed)
+        options = [random_option(rng) for _ in range(n_options)]
+        fwd_prices = np.array([rng.uniform(80.0, 120.0) for _ in range(n_options)])
+        # A handful of distinct vols, so American options share grids
+        sigmas = np.array([0.1 + 0.1 * rng.randint(0, 3) for _ in range(n_options)])
+        return options, fwd_prices, sigmas
+
+    def test_matches_instrument_values(self):
+        seed = np.random.randint(0, 100 * 1000)
+        options, fwd_prices, sigmas = self.random_book(seed, 60)
+        market_day = Day(2018, 1, 1)
+        r = 0.05
+
+        portfolio = OptionPortfolio.from_instruments(options)
+        for method in AmericanMethod:
+            values = portfolio.values(market_day, fwd_prices, sigmas, r, american_method=method)
+            for i, option in enumerate(options):
+                self.assertAlmostEqual(
+                    values[i], option.value(market_day, fwd_prices[i], sigmas[i], r, american_method=method),
+                    delta=1e-9, msg=f"Seed was {seed}"
+                )
+
+    def test_shared_market_data(self):
+        market_day = Day(2018, 1, 1)
+        portfolio = OptionPortfolio(
+            [90.0, 100.0, 110.0],
+            [OptionRight.CALL.value, OptionRight.PUT.value, OptionRight.STRADDLE.value],
+            [Day(2018, 3, 1), Day(2018, 6, 1), Day(2018, 6, 1)],
+            [False, True, True]
+        )
+        values = portfolio.values(market_day, 100.0, 0.25, 0.03)
+        np.testing.assert_allclose(
+            portfolio.times_to_expiry(market_day),
+            [Day(2018, 3, 1).time_since(market_day), Day(2018, 6, 1).time_since(market_day),
+             Day(2018, 6, 1).time_since(market_day)]
+        )
+        self.assertEqual(len(values), 3)
+        self.assertTrue(np.all(values > 0.0))
+
+    def test_rejects_misaligned_columns(self):
+        with self.assertRaises(Exception):
+            OptionPortfolio([90.0, 100.0], [1], [Day(2018, 3, 1)] * 2, [False, True])
@@ -0,0 +1,83 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from models.day import Day
+from models.option import ExerciseStyle, OptionRight
+from models.option_calcs import crank_nicholson_value, intrinsic_values
+from models.option_instrument import OptionInstrument
+from models.pricing_surface import AmericanPricingSurface
+
+
+class PricingSurfaceTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.surface = AmericanPricingSurface.build(
+            standardized_moneyness=np.linspace(-4.0, 4.0, 81),
+            total_vols=np.linspace(0.1, 0.5, 9),
+            rate_times=np.linspace(0.0, 0.1, 11),
+            n=200, n_times=200, std_devs=6.0
+        )
+
+    def test_matches_crank_nicholson_at_nodes(self):
+        for right in OptionRight:
+            for total_vol, rate_time, y in [(0.2, 0.05, 0.0), (0.35, 0.0, -1.2), (0.5, 0.1, 2.0)]:
+                fwd_price = 100.0 * np.exp(y * total_vol)
+                value = self.surface.option_values(right.value, 100.0, fwd_price, total_vol, 1.0, rate_time)[0]
+                expected = crank_nicholson_value(
+                    right, ExerciseStyle.AMERICAN, 100.0, fwd_price, total_vol, rate_time, 1.0, 200, 200, 6.0
+                )
+                self.assertAlmostEqual(value, expected, delta=1e-3)
+
+    def test_interpolation_within_error_bound(self):
+        rng = np.random.default_rng(42)
+        n_options = 40
+        rights = rng.integers(1, 4, n_options)
+        strikes = rng.uniform(80.0, 120.0, n_options)
+        fwd_prices = rng.uniform(80.0, 120.0, n_options)
+        ts = rng.uniform(0.25, 2.0, n_options)
+        sigmas = rng.uniform(0.1, 0.5, n_options) / np.sqrt(ts)
+        rs = rng.uniform(0.0, 0.1, n_options) / ts
+
+        values = self.surface.option_values(rights, strikes, fwd_prices, sigmas, ts, rs)
+        bounds = self.surface.error_bounds(rights, strikes, fwd_prices, sigmas, ts, rs)
+        self.assertFalse(np.any(np.isnan(bounds)))
+        for i in range(n_options):
+            expected = crank_nicholson_value(
+                OptionRight(int(rights[i])), ExerciseStyle.AMERICAN, strikes[i], fwd_prices[i], sigmas[i], rs[i],
+                ts[i], 400, 400, 6.0
+            )
+            # The bound covers interpolation only, so allow for the coarse table's PDE error as well
+            self.assertLessEqual(abs(values[i] - expected), bounds[i] + 0.01)
+
+    def test_falls_back_to_crank_nicholson_off_surface(self):
+        value = self.surface.option_values(OptionRight.PUT.value, 100.0, 95.0, 0.8, 1.0, 0.05)[0]
+        expected = crank_nicholson_value(OptionRight.PUT, ExerciseStyle.AMERICAN, 100.0, 95.0, 0.8, 0.05, 1.0,
+                                         100, 100, 4.0)
+        self.assertEqual(value, expected)
+        self.assertTrue(np.isnan(self.surface.error_bounds(OptionRight.PUT.value, 100.0, 95.0, 0.8, 1.0, 0.05)[0]))
+
+    def test_zero_vol_is_intrinsic(self):
+        strikes = np.array([90.0, 100.0, 110.0])
+        for right in OptionRight:
+            np.testing.assert_allclose(
+                self.surface.option_values(right.value, strikes, 100.0, 0.0, 1.0, 0.05),
+                intrinsic_values(right.value, strikes, 100.0)
+            )
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "surface.npz")
+            self.surface.save(path)
+            loaded = AmericanPricingSurface.load(path)
+        np.testing.assert_array_equal(loaded.time_values, self.surface.time_values)
+        np.testing.assert_array_equal(loaded.cell_bounds, self.surface.cell_bounds)
+
+    def test_instrument_surface_value(self):
+        market_day = Day(2018, 1, 1)
+        option = OptionInstrument(100.0, OptionRight.PUT, Day(2018, 7, 1), ExerciseStyle.AMERICAN)
+        value = option.surface_value(market_day, 98.0, 0.3, 0.05, self.surface)
+        self.assertAlmostEqual(value, option.cn_value(market_day, 98.0, 0.3, 0.05), delta=0.02)
@@ -1,6 +1,10 @@
+import os
+import tempfile
+
 import numpy as np
 
-from models.sobol_generator import SobolGenerator
+from models import sobol_generator
+from models.sobol_generator import SobolGenerator, build_direction_table, direction_numbers, sobol_shards
 from tests.pimpedrandom import PimpedRandom
 from tests.stats_test_mixin import StatsTestMixin
 
@@ -30,3 +34,122 @@ class SobolSeqTest(StatsTestMixin):
                         tol=0.03,
                         msg=f"Seed = {seed}"
                     )
+
+    def test_matches_path_by_path_generation(self):
+        rng = PimpedRandom()
+
+        for _ in range(5):
+            seed = np.random.randint(0, 100 * 1000)
+            rng.seed(seed)
+            n_variables = rng.randint(1, 50)
+            n_paths = rng.randint(1, 3000)
+            sd = SobolGenerator(n_variables)
+
+            expected = np.zeros((n_paths, n_variables), float)
+            x = np.zeros((n_variables,), np.uint64)
+            for i_path in range(n_paths):
+                c = 1
+                value = i_path
+                while (value & 1) == 1:
+                    value >>= 1
+                    c += 1
+                x ^= sd.directions[:, c]
+                expected[i_path] = x * sd.scale
+
+            np.testing.assert_array_equal(
+                sd.generate(n_paths, block_size=rng.randint(1, 500)),
+                np.transpose(expected),
+                err_msg=f"Seed = {seed}"
+            )
+
+    def test_generate_into_buffer(self):
+        n_variables = 7
+        n_paths = 1000
+        sd = SobolGenerator(n_variables)
+        out = np.zeros((n_variables, n_paths), float)
+        result = sd.generate(n_paths, out=out)
+        self.assertIs(result, out)
+        np.testing.assert_array_equal(out, sd.generate(n_paths))
+
+    def test_direction_numbers_are_cached(self):
+        d1 = direction_numbers(20)
+        d2 = direction_numbers(20)
+        self.assertIs(d1, d2)
+        self.assertIs(SobolGenerator(20).directions, d1)
+        np.testing.assert_array_equal(d1, build_direction_table()[:20])
+
+    def test_direction_table_without_writable_cache(self):
+        saved_table, saved_cache = sobol_generator._direction_table, dict(sobol_generator._direction_cache)
+        saved_dir = os.environ.get("PYMODELS_CACHE_DIR")
+        with tempfile.TemporaryDirectory() as directory:
+            missing_dir = os.path.join(directory, "missing")
+            os.environ["PYMODELS_CACHE_DIR"] = missing_dir
+            sobol_generator._direction_table = None
+            sobol_generator._direction_cache.clear()
+            try:
+                np.testing.assert_array_equal(SobolGenerator(20).directions, build_direction_table()[:20])
+                self.assertFalse(os.path.exists(missing_dir))
+            finally:
+                if saved_dir is None:
+                    del os.environ["PYMODELS_CACHE_DIR"]
+                else:
+                    os.environ["PYMODELS_CACHE_DIR"] = saved_dir
+                sobol_generator._direction_table = saved_table
+                sobol_generator._direction_cache.clear()
+                sobol_generator._direction_cache.update(saved_cache)
+
+    def test_skip_ahead(self):
+        rng = PimpedRandom()
+
+        for _ in range(5):
+            seed = np.random.randint(0, 100 * 1000)
+            rng.seed(seed)
+            n_variables = rng.randint(1, 20)
+            sd = SobolGenerator(n_variables)
+            n_paths = rng.randint(100, 5000)
+            start = rng.randint(0, n_paths - 1)
+            sample = sd.generate(n_paths)
+
+            np.testing.assert_array_equal(
+                sd.generate(n_paths - start, start=start),
+                sample[:, start:],
+                err_msg=f"Seed = {seed}"
+            )
+
+    def test_shards_cover_sequence(self):
+        rng = PimpedRandom()
+
+        for _ in range(20):
+            seed = np.random.randint(0, 100 * 1000)
+            rng.seed(seed)
+            n_paths = rng.randint(1, 10000)
+            n_shards = rng.randint(1, 16)
+            start = rng.randint(0, 1000)
+            shards = sobol_shards(n_paths, n_shards, start)
+
+            self.assertEqual(shards[0][0], start, f"Seed = {seed}")
+            self.assertEqual(sum(n for _, n in shards), n_paths, f"Seed = {seed}")
+            for (s1, n1), (s2, _) in zip(shards, shards[1:]):
+                self.assertEqual(s1 + n1, s2, f"Seed = {seed}")
+
+    def test_scrambling_keeps_stratification(self):
+        rng = PimpedRandom()
+
+        for _ in range(5):
+            seed = np.random.randint(0, 100 * 1000)
+            rng.seed(seed)
+            n_variables = rng.randint(1, 10)
+            n_paths = 1 << rng.randint(6, 12)
+
+            # Points n_paths to 2 * n_paths - 1 form a net, so each 1 / n_paths interval holds one point
+            sample = SobolGenerator(n_variables, seed=seed).generate(n_paths, start=n_paths - 1)
+
+            self.assertFalse(np.array_equal(sample, SobolGenerator(n_variables).generate(n_paths, start=n_paths - 1)))
+            np.testing.assert_array_equal(
+                sample,
+                SobolGenerator(n_variables, seed=seed).generate(n_paths, start=n_paths - 1)
+            )
+
+            for i_var in range(n_variables):
+                counts = np.bincount((sample[i_var] * n_paths).astype(int), minlength=n_paths)
+                np.testing.assert_array_equal(counts, 1, err_msg=f"Seed = {seed}")
@@ -16,7 +16,7 @@ class StatsTestMixin(unittest.TestCase):
     def check_mean(self, arr, expected, tol, msg=""):
         self.assertAlmostEqual(
             expected,
-            np.asscalar(np.mean(arr)),
+            float(np.mean(arr)),
             delta=tol,
             msg=msg
         )
@@ -24,7 +24,7 @@ class StatsTestMixin(unittest.TestCase):
     def check_std_dev(self, arr, expected, tol, msg=""):
         self.assertAlmostEqual(
             expected,
-            np.asscalar(np.std(arr)),
+            float(np.std(arr)),
             delta=tol,
             msg=msg
         )
@@ -1,7 +1,11 @@
+import os
+import tempfile
+
 import numpy as np
 
-from models.brownian_generator import generate_brownians
-from models.storage_model import CombinedPriceProcess, state_ranges, value_storage_unit
+from models.brownian_generator import BrownianLayout, generate_brownians
+from models.storage_model import CombinedPriceProcess, StoragePolicy, state_ranges, value_storage_unit, \
+    forward_value_storage_unit, streaming_value_storage_unit, _storage_path_values, _design_matrix, cond_exp
 from tests.pimpedrandom import PimpedRandom
 from tests.stats_test_mixin import StatsTestMixin
 from tests.test_utils import random_times
@@ -82,4 +86,129 @@ class StorageModelTest(StatsTestMixin):
             process=process,
             n_paths=n_paths
         )
-        self.assertAlmostEqual(value, 5.0, delta = 0.01)
+        # Buy one unit at 10.0, sell it at 15.5
+        self.assertAlmostEqual(value, 5.5, delta = 0.01)
+
+    def test_streaming_value(self):
+        times = np.array([0.25, 0.5, 0.75])
+        process = CombinedPriceProcess(np.array([10.0, 12.0, 11.0]), times, sigma=0.3, tilt_vol=0.5)
+        estimate = streaming_value_storage_unit(
+            initial_volume=1, max_volume=2, process=process, max_paths=512, chunk_size=128
+        )
+        self.assertEqual(estimate.n_paths, 512)
+
+        chunk_values = []
+        for start in range(0, 512, 128):
+            brownians = generate_brownians(
+                128, 2, times, start=start, layout=BrownianLayout.TIME_MAJOR,
+                correlation=process.correlation_matrix()
+            )
+            chunk_values.append(np.mean(
+                _storage_path_values(1, 2, process, brownians, BrownianLayout.TIME_MAJOR)
+            ))
+        self.assertAlmostEqual(estimate.value, np.mean(chunk_values), delta=1e-10)
+        self.assertAlmostEqual(estimate.std_err, np.std(chunk_values, ddof=1) / 2.0, delta=1e-10)
+
+    def test_vectorized_exercise_matches_path_loop(self):
+        rng = PimpedRandom()
+        seed = np.random.randint(0, 100 * 1000)
+        rng.seed(seed)
+
+        n_times = 6
+        times = random_times(rng, n_times) + 0.1
+        fwd_prices = np.array([rng.uniform(9.0, 11.0) for _ in range(n_times)])
+        process = CombinedPriceProcess(fwd_prices, times, sigma=0.3, tilt_vol=0.5, correlation=0.4)
+        max_volume = 3
+        initial_volume = rng.randint(0, max_volume)
+        brownians = generate_brownians(256, 2, times, correlation=process.correlation_matrix())
+
+        np.testing.assert_allclose(
+            _storage_path_values(initial_volume, max_volume, process, brownians),
+            _path_loop_values(initial_volume, max_volume, process, brownians),
+            err_msg=f"Seed was {seed}"
+        )
+
+    def test_cond_exp_regresses_all_states_at_once(self):
+        rng = np.random.default_rng(5)
+        design_matrix = np.column_stack([np.ones(200), rng.normal(size=(200, 3))])
+        option_values = rng.normal(size=(4, 200))
+        together = cond_exp(design_matrix, option_values)
+        for i_state in range(4):
+            np.testing.assert_allclose(together[i_state], cond_exp(design_matrix, option_values[i_state]))
+
+        # Out of sample: each half is predicted from the other half's least squares fit
+        fit = np.linalg.lstsq(design_matrix[100:], option_values[0, 100:], rcond=None)[0]
+        np.testing.assert_allclose(together[0, :100], design_matrix[:100] @ fit)
+
+    def test_scratch_file_value_matches_in_memory(self):
+        times = np.linspace(0.05, 0.5, 10)
+        process = CombinedPriceProcess(10.0 + np.sin(times * 10.0), times, sigma=0.3, tilt_vol=0.5, correlation=0.3)
+        in_memory = value_storage_unit(2, 4, process, n_paths=1000)
+        with tempfile.TemporaryDirectory() as scratch_dir:
+            spilled = value_storage_unit(2, 4, process, n_paths=1000, scratch_dir=scratch_dir, chunk_size=256)
+        self.assertAlmostEqual(spilled, in_memory, delta=1e-10)
+
+    def test_policy_forward_value(self):
+        times = np.linspace(0.05, 0.5, 10)
+        process = CombinedPriceProcess(10.0 + np.sin(times * 10.0), times, sigma=0.3, tilt_vol=0.5, correlation=0.3)
+        value, policy = value_storage_unit(2, 4, process, n_paths=4096, return_policy=True)
+        self.assertEqual(value, value_storage_unit(2, 4, process, n_paths=4096))
+        self.assertEqual(policy.coefficients.shape, (10, 5, 6))
+
+        # Fresh paths: the stored policy is suboptimal there, so it can only lose a little value
+        out_of_sample = forward_value_storage_unit(policy, process, n_paths=4096, start=4096)
+        self.assertLess(out_of_sample.value, value + 3.0 * out_of_sample.std_err)
+        self.assertGreater(out_of_sample.value, 0.95 * value)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "policy.npz")
+            policy.save(path)
+            loaded = StoragePolicy.load(path)
+        self.assertEqual((loaded.initial_volume, loaded.max_volume), (2, 4))
+        np.testing.assert_array_equal(loaded.coefficients, policy.coefficients)
+        self.assertEqual(forward_value_storage_unit(loaded, process, 1024).value,
+                         forward_value_storage_unit(policy, process, 1024).value)
+
+        with self.assertRaises(Exception):
+            forward_value_storage_unit(policy, CombinedPriceProcess(process.fwd_prices[:5], times[:5], 0.3, 0.5), 64)
+
+    def test_policy_on_shifted_curve(self):
+        times = np.array([0, 1])
+        process = CombinedPriceProcess(np.array([10.0, 15.5]), times, sigma=0.0, tilt_vol=0.0)
+        value, policy = value_storage_unit(0, 1, process, n_paths=10, return_policy=True)
+        self.assertAlmostEqual(value, 5.5, delta=0.01)
+
+        # The continuation value of holding a unit stays 15.5; the transfers use the new prices
+        higher = CombinedPriceProcess(np.array([10.0, 20.0]), times, sigma=0.0, tilt_vol=0.0)
+        self.assertAlmostEqual(forward_value_storage_unit(policy, higher, 10).value, 10.0, delta=0.01)
+        dearer = CombinedPriceProcess(np.array([16.0, 15.5]), times, sigma=0.0, tilt_vol=0.0)
+        self.assertAlmostEqual(forward_value_storage_unit(policy, dearer, 10).value, 0.0, delta=0.01)
+
+
+def _path_loop_values(initial_volume, max_volume, process, brownians):
+    # Exercise decision path by path, the way value_storage_unit used to make it
+    n_paths = len(brownians)
+    n_times = len(process.times)
+    min_levels, max_levels = state_ranges(initial_volume, max_volume, n_times)
+    state_values_eod = np.zeros((max_volume + 1, n_paths))
+    state_values_sod = np.zeros((max_volume + 1, n_paths))
+
+    for i_exercise in range(n_times - 1, -1, -1):
+        min_eod, max_eod = min_levels[i_exercise + 1], max_levels[i_exercise + 1]
+        dm = _design_matrix(brownians, i_exercise)
+        cond_exps = {i_eod: cond_exp(dm, state_values_eod[i_eod]) for i_eod in range(min_eod, max_eod + 1)}
+        prices = process.generate(brownians, i_exercise)
+
+        for i_sod in range(min_levels[i_exercise], max_levels[i_exercise] + 1):
+            for i_path in range(n_paths):
+                best_eod, best_value = None, None
+                for i_eod in range(max(i_sod - 1, min_eod), min(i_sod + 1, max_eod) + 1):
+                    value = prices[i_path] * (i_sod - i_eod) + cond_exps[i_eod][i_path]
+                    if best_value is None or value > best_value:
+                        best_eod, best_value = i_eod, value
+                state_values_sod[i_sod, i_path] = prices[i_path] * (i_sod - best_eod) + state_values_eod[
+                    best_eod, i_path]
+
+        state_values_eod, state_values_sod = state_values_sod, state_values_eod
+
+    return state_values_eod[initial_volume]